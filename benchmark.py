@@ -0,0 +1,389 @@
+#!/usr/bin/python
+
+# Benchmark for scram2cmake that doesn't need a CMSSW checkout. It generates a
+# synthetic SCRAM project, runs the phases of scram2cmake.main() on it and
+# reports the time and peak memory of each phase. Results can be stored as a
+# baseline and later runs can be compared against it. With --compare-backends
+# it instead measures generating, configuring and building the project with the
+# CMake backend and with the native Ninja backend, and --compare-usage-requirements
+# compares the size and configure time of the CMake files with and without
+# --usage-requirements. --check-determinism checks that two runs with different
+# hash seeds generate byte-identical files.
+
+import os, sys, time, json, random, shutil, hashlib, tempfile, argparse, tracemalloc, subprocess
+
+import scram2cmake
+
+# Externals from builtin.json that synthetic packages depend on.
+externals = ["boost", "clhep", "root", "tbb", "HepMC"]
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+# Creates a synthetic SCRAM project in the given directory. The packages are
+# arranged in `config.depth` layers and every package depends on up to
+# `config.fanout` random packages from the layers below it.
+def generate_project(root, config):
+    rng = random.Random(config.seed)
+    packages = []
+    for s in range(config.subsystems):
+        for p in range(config.packages):
+            packages.append("Subsystem%d/Package%d" % (s, p))
+    rng.shuffle(packages)
+
+    layers = [packages[i::config.depth] for i in range(config.depth)]
+    for layer_index, layer in enumerate(layers):
+        candidates = [p for l in layers[:layer_index] for p in l]
+        for package in layer:
+            deps = rng.sample(candidates, min(config.fanout, len(candidates)))
+            generate_package(os.path.join(root, package), package, sorted(deps), config, rng)
+    return packages
+
+def generate_package(path, package, deps, config, rng):
+    symbol = package.replace("/", "")
+    add_subdir = rng.random() < config.subdir_ratio
+    has_dict = rng.random() < config.dict_ratio
+
+    build_file = ""
+    for dep in deps:
+        build_file += "<use name=\"" + dep + "\"/>\n"
+    build_file += "<use name=\"" + rng.choice(config.externals) + "\"/>\n"
+    if add_subdir:
+        build_file += "<flags ADD_SUBDIR=\"1\"/>\n"
+    build_file += "<export>\n  <lib name=\"1\"/>\n</export>\n"
+    write_file(os.path.join(path, "BuildFile.xml"), build_file)
+
+    dep_headers = ["#include \"" + dep + "/interface/Header0.h\"\n" for dep in deps]
+    for i in range(config.headers):
+        write_file(os.path.join(path, "interface", "Header%d.h" % i),
+                   "#ifndef " + symbol + "_Header%d_h\n" % i +
+                   "#define " + symbol + "_Header%d_h\n" % i +
+                   "".join(dep_headers) +
+                   "#include <vector>\n" +
+                   "class " + symbol + "Class%d { std::vector<int> v; };\n" % i +
+                   "#endif\n")
+
+    for i in range(config.sources):
+        src_dir = "src"
+        if add_subdir and i % 2:
+            src_dir = os.path.join("src", "detail")
+        write_file(os.path.join(path, src_dir, "Source%d.cc" % i),
+                   "#include \"" + package + "/interface/Header%d.h\"\n" % (i % config.headers) +
+                   "".join(dep_headers) +
+                   "int " + symbol + "Function%d() { return %d; }\n" % (i, i))
+
+    if has_dict:
+        write_file(os.path.join(path, "src", "classes.h"),
+                   "#include \"" + package + "/interface/Header0.h\"\n")
+        write_file(os.path.join(path, "src", "classes_def.xml"),
+                   "<lcgdictionary>\n  <class name=\"" + symbol + "Class0\"/>\n</lcgdictionary>\n")
+
+    if config.bins:
+        write_file(os.path.join(path, "bin", "main.cc"), "int main() { return 0; }\n")
+        write_file(os.path.join(path, "bin", "BuildFile.xml"),
+                   "<use name=\"" + package + "\"/>\n"
+                   "<bin file=\"main.cc\" name=\"" + symbol + "Main\"></bin>\n")
+    if config.tests:
+        write_file(os.path.join(path, "test", "test.cpp"), "int main() { return 0; }\n")
+        write_file(os.path.join(path, "test", "BuildFile.xml"),
+                   "<bin file=\"test.cpp\" name=\"test" + symbol + "\">\n"
+                   "  <use name=\"" + package + "\"/>\n</bin>\n")
+    if config.plugins:
+        write_file(os.path.join(path, "plugins", "Plugin.cc"),
+                   "#include \"" + package + "/interface/Header0.h\"\n")
+        write_file(os.path.join(path, "plugins", "BuildFile.xml"),
+                   "<library file=\"*.cc\" name=\"" + symbol + "Plugins\">\n"
+                   "  <use name=\"" + package + "\"/>\n"
+                   "  <flags EDM_PLUGIN=\"1\"/>\n</library>\n")
+
+    # Directories that the scanner shouldn't need to visit.
+    write_file(os.path.join(path, "python", "__init__.py"), "")
+    write_file(os.path.join(path, "data", "samples", "input.txt"), "")
+
+# Runs all phases of scram2cmake.main() in the current directory and returns
+# the files that were generated. `measure(name, function)` is called for each phase.
+def run_phases(measure):
+    packages = measure("scan", lambda: scram2cmake.scan_packages()[0])
+    modules = measure("parse", lambda: scram2cmake.parse_packages(packages))
+    project = measure("resolve_dependencies", lambda: scram2cmake.create_project(modules))
+    generator = scram2cmake.CMakeGenerator(project)
+    measure("gen", lambda: (generator.gen_modules(), generator.gen_top_level()))
+    if scram2cmake.cxxmodules:
+        measure("gen_module_map", generator.gen_module_map)
+    # With --incremental the files of the previous run are removed as well, so
+    # this measures writing all files plus hashing them for the manifest.
+    measure("write_incremental" if scram2cmake.incremental else "write", generator.output.commit)
+    return list(generator.output.files)
+
+def remove_generated(files):
+    for path in files + [scram2cmake.OutputTree.manifest_path]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+# Runs the phases `repeat` times and returns phase -> {'time': best time in
+# seconds, 'peak': peak of allocated memory in bytes}. The memory is measured in
+# a separate run, as tracing allocations slows down everything else.
+def benchmark(repeat, keep_cache):
+    results = {}
+
+    def timed(name, function):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        entry = results.setdefault(name, {"time": elapsed, "peak": 0})
+        entry["time"] = min(entry["time"], elapsed)
+        return result
+
+    def traced(name, function):
+        tracemalloc.reset_peak()
+        result = function()
+        results[name]["peak"] = tracemalloc.get_traced_memory()[1]
+        return result
+
+    for i in range(repeat + 1):
+        if i == repeat:
+            tracemalloc.start()
+        files = run_phases(traced if i == repeat else timed)
+        if i == repeat:
+            tracemalloc.stop()
+        remove_generated(files)
+        if not keep_cache and os.path.isfile(scram2cmake.ProjectCache.path):
+            os.remove(scram2cmake.ProjectCache.path)
+    return results
+
+# Runs the given command in the current directory and returns how long it took.
+def timed_command(command):
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+# Generates, configures (only CMake) and builds the project in the current
+# directory with both backends and returns backend -> step -> wall time in seconds.
+def compare_backends(scram2cmake_args, build_jobs):
+    script = [sys.executable, os.path.abspath(scram2cmake.__file__)] + scram2cmake_args
+    ninja_jobs = ["-j", str(build_jobs)] if build_jobs else []
+    for path in ("build", "build-cmake"):
+        shutil.rmtree(path, ignore_errors=True)
+
+    results = {}
+    results["cmake"] = {
+        "generate": timed_command(script),
+        "configure": timed_command(["cmake", "-G", "Ninja", "-S", ".", "-B", "build-cmake"]),
+        "build": timed_command(["ninja", "-C", "build-cmake"] + ninja_jobs),
+    }
+    results["ninja"] = {
+        "generate": timed_command(script + ["--ninja"]),
+        "configure": 0.0,
+        "build": timed_command(["ninja"] + ninja_jobs),
+    }
+    return results
+
+# Returns the total size of the CMakeLists.txt files in the current directory
+# (without the build directories).
+def cmake_files_size():
+    size = 0
+    for root, dirs, files in os.walk("."):
+        dirs[:] = [d for d in dirs if not d.startswith("build")]
+        if "CMakeLists.txt" in files:
+            size += os.path.getsize(os.path.join(root, "CMakeLists.txt"))
+    return size
+
+# Generates and configures the CMake files of the project in the current
+# directory with flattened dependency closures (the default) and with
+# '--usage-requirements'. Returns mode -> {'generate': seconds, 'size': bytes
+# of all CMakeLists.txt files, 'configure': seconds}.
+def compare_usage_requirements(scram2cmake_args):
+    script = [sys.executable, os.path.abspath(scram2cmake.__file__)] + scram2cmake_args
+    results = {}
+    for mode, args in (("flattened", []), ("usage", ["--usage-requirements"])):
+        build_dir = "build-" + mode
+        shutil.rmtree(build_dir, ignore_errors=True)
+        results[mode] = {"generate": timed_command(script + args), "size": cmake_files_size(),
+                         "configure": timed_command(["cmake", "-S", ".", "-B", build_dir])}
+    return results
+
+# Returns path -> SHA-256 of all files in the current directory (without the
+# build directories, the parse cache and the manifest).
+def snapshot_files():
+    skipped = {scram2cmake.ProjectCache.path, scram2cmake.OutputTree.manifest_path}
+    result = {}
+    for root, dirs, files in os.walk("."):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("build"))
+        for name in sorted(files):
+            path = os.path.normpath(os.path.join(root, name))
+            if path in skipped:
+                continue
+            with open(path, "rb") as f:
+                result[path] = hashlib.sha256(f.read()).hexdigest()
+    return result
+
+# Runs scram2cmake twice in the current directory, with a different
+# PYTHONHASHSEED each time and without any state from the previous run, and
+# returns the paths of the generated files that differ between the runs (or
+# were only generated by one of them).
+def check_determinism(scram2cmake_args):
+    script = [sys.executable, os.path.abspath(scram2cmake.__file__)] + scram2cmake_args
+    before = snapshot_files()
+    runs = []
+    for seed in ("1", "2"):
+        remove_generated([scram2cmake.ProjectCache.path])
+        subprocess.run(script, check=True, stdout=subprocess.DEVNULL,
+                       env=dict(os.environ, PYTHONHASHSEED=seed))
+        after = snapshot_files()
+        generated = {path: digest for path, digest in after.items() if before.get(path) != digest}
+        remove_generated([path for path in generated if path not in before])
+        runs.append(generated)
+    return sorted(path for path in set(runs[0]) | set(runs[1])
+                  if runs[0].get(path) != runs[1].get(path))
+
+def print_usage_results(results):
+    print("%-10s %10s %12s %10s" % ("mode", "generate", "size [KiB]", "configure"))
+    for mode, result in results.items():
+        print("%-10s %10.2f %12d %10.2f" % (mode, result["generate"], result["size"] // 1024,
+                                           result["configure"]))
+
+def print_backend_results(results):
+    print("%-8s %10s %10s %10s %10s" % ("backend", "generate", "configure", "build", "total"))
+    for backend, steps in results.items():
+        print("%-8s %10.2f %10.2f %10.2f %10.2f" % (backend, steps["generate"], steps["configure"],
+                                                    steps["build"], sum(steps.values())))
+
+def print_results(results, baseline, tolerance):
+    regressions = []
+    print("%-22s %10s %12s" % ("phase", "time [s]", "peak [KiB]"))
+    for name, result in results.items():
+        line = "%-22s %10.4f %12d" % (name, result["time"], result["peak"] // 1024)
+        if baseline and name in baseline:
+            old = baseline[name]
+            time_ratio = result["time"] / old["time"] if old["time"] else 1
+            peak_ratio = result["peak"] / old["peak"] if old["peak"] else 1
+            line += "   (%+.0f%% time, %+.0f%% memory)" % ((time_ratio - 1) * 100,
+                                                          (peak_ratio - 1) * 100)
+            if time_ratio > 1 + tolerance or peak_ratio > 1 + tolerance:
+                regressions.append(name)
+        print(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scram2cmake on a synthetic SCRAM project.")
+    parser.add_argument("--subsystems", type=int, default=20)
+    parser.add_argument("--packages", type=int, default=25, help="packages per subsystem")
+    parser.add_argument("--sources", type=int, default=8, help="source files per package")
+    parser.add_argument("--headers", type=int, default=8, help="headers per package")
+    parser.add_argument("--fanout", type=int, default=6, help="direct dependencies per package")
+    parser.add_argument("--depth", type=int, default=10, help="number of dependency layers")
+    parser.add_argument("--dict-ratio", type=float,
+                        help="share of packages with classes.h (default: 0.3, with --compare-backends "
+                             "0 unless genreflex is installed)")
+    parser.add_argument("--subdir-ratio", type=float, default=0.1, help="share of packages with ADD_SUBDIR")
+    parser.add_argument("--no-bins", dest="bins", action="store_false")
+    parser.add_argument("--no-tests", dest="tests", action="store_false")
+    parser.add_argument("--no-plugins", dest="plugins", action="store_false")
+    parser.add_argument("--externals",
+                        help="comma separated builtin.json externals the packages depend on (default: " +
+                             ",".join(externals) + ", with --compare-backends only HepMC, which "
+                             "doesn't need any installed libraries)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per phase (the best time is reported)")
+    parser.add_argument("--warm-cache", action="store_true", help="keep the parse cache between runs")
+    parser.add_argument("--project", help="use (or create) the synthetic project in this directory")
+    parser.add_argument("--compare-backends", action="store_true",
+                        help="compare the wall time of generate+configure+build with the CMake and the "
+                             "Ninja backend (needs cmake, ninja and a C++ compiler)")
+    parser.add_argument("--build-jobs", type=int, help="parallel jobs for ninja with --compare-backends")
+    parser.add_argument("--compare-usage-requirements", action="store_true",
+                        help="compare the size and CMake configure time of the generated files with "
+                             "and without --usage-requirements (needs cmake)")
+    parser.add_argument("--check-determinism", action="store_true",
+                        help="check that two runs with different hash seeds generate identical files")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--save-baseline", help="store the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative slowdown/memory growth before reporting a regression")
+    parser.add_argument("scram2cmake_args", nargs="*",
+                        help="options for scram2cmake (after '--', e.g. -- --modules -j 4)")
+    config = parser.parse_args()
+
+    if config.externals:
+        config.externals = config.externals.split(",")
+    else:
+        config.externals = ["HepMC"] if config.compare_backends else externals
+    if config.dict_ratio is None:
+        config.dict_ratio = 0 if config.compare_backends and not shutil.which("genreflex") else 0.3
+    tools = []
+    if config.compare_backends:
+        tools = ["cmake", "ninja"]
+    elif config.compare_usage_requirements:
+        tools = ["cmake"]
+    missing = [tool for tool in tools if not shutil.which(tool)]
+    if missing:
+        print("This comparison needs " + " and ".join(missing) + " in the PATH")
+        exit(1)
+
+    baseline = None
+    if config.baseline:
+        with open(config.baseline) as f:
+            baseline = json.load(f)["phases"]
+
+    scram2cmake.parse_args(config.scram2cmake_args)
+    if not config.warm_cache:
+        scram2cmake.useCache = False
+
+    project_dir = config.project or tempfile.mkdtemp(prefix="scram2cmake-bench-")
+    cwd = os.getcwd()
+    try:
+        if not os.path.isfile(os.path.join(project_dir, ".synthetic")):
+            os.makedirs(project_dir, exist_ok=True)
+            packages = generate_project(project_dir, config)
+            write_file(os.path.join(project_dir, ".synthetic"), "")
+            print("Generated " + str(len(packages)) + " packages in " + project_dir)
+        os.chdir(project_dir)
+        scram2cmake.prefix = os.getcwd() + os.sep
+        args = config.scram2cmake_args + ([] if config.warm_cache else ["--no-cache"])
+        if config.compare_backends:
+            results = compare_backends(args, config.build_jobs)
+        elif config.compare_usage_requirements:
+            results = compare_usage_requirements(args)
+        elif config.check_determinism:
+            results = check_determinism(args)
+        else:
+            results = benchmark(config.repeat, config.warm_cache)
+    except subprocess.CalledProcessError as e:
+        print("Command failed: " + " ".join(e.cmd))
+        exit(1)
+    finally:
+        os.chdir(cwd)
+        if not config.project:
+            shutil.rmtree(project_dir)
+
+    if config.compare_backends:
+        print_backend_results(results)
+        return
+    if config.compare_usage_requirements:
+        print_usage_results(results)
+        return
+    if config.check_determinism:
+        if results:
+            print("Generated files differ between runs:")
+            for path in results:
+                print("  " + path)
+            exit(1)
+        print("Generated files are identical")
+        return
+
+    regressions = print_results(results, baseline, config.tolerance)
+
+    if config.save_baseline:
+        with open(config.save_baseline, "w") as f:
+            json.dump({"config": {k: v for k, v in vars(config).items()
+                                  if k not in ("baseline", "save_baseline", "project")},
+                       "phases": results}, f, indent=1)
+
+    if regressions:
+        print("Regressions in: " + ", ".join(regressions))
+        exit(1)
+
+if __name__ == "__main__":
+    main()
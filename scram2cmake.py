@@ -1,6 +1,8 @@
 #!/usr/bin/python
 
-import os, glob, shutil, sys, subprocess, re
+import os, glob, sys, subprocess, re, fnmatch, shlex
+import multiprocessing, pickle, sqlite3, hashlib, io, time, contextlib, cProfile
+import concurrent.futures
 import xml.etree.ElementTree as ET
 import json
 
@@ -16,8 +18,45 @@ cxxmodules = False
 perHeaderModules = False
 printTextualHeaders = False
 noLink = False
+scanStats = False
+# Number of worker processes used for parsing the packages and generating
+# the CMake files (and of threads for writing them).
+jobs = 1
+useCache = True
+incremental = False
+graphReport = False
+# Write a compile_commands.json instead of CMake files.
+compileCommands = False
+# Write a build.ninja instead of CMake files.
+ninjaBuild = False
+# Packages (e.g. 'FWCore/Version') given with '--only'. If set, only these
+# packages and their dependencies are parsed and generated.
+onlyPackages = None
+# Path to the base release given with '--release'.
+releasePath = None
+# Emit precompiled headers for the targets with '--pch'.
+precompiledHeaders = False
+# Number of sources per unity build batch given with '--unity' (0 = no unity builds).
+unityBatchSize = 0
+# Only pass the include directories to each target that it uses ('--prune-includes').
+pruneIncludes = False
+# Only emit the direct dependencies of the targets and let CMake propagate the
+# usage requirements ('--usage-requirements').
+usageRequirements = False
+# Write one module map per package instead of a single module.modulemap
+# ('--sharded-modulemaps').
+shardedModuleMaps = False
+# Prioritize the PCMs on the critical path of the module pre-build ('--pcm-schedule').
+pcmSchedule = False
+# Command (e.g. 'ccache') that runs the compiler given with '--launcher'.
+compilerLauncher = None
+# Options for building the ROOT dictionaries with '--dicts'.
+makeDicts = False
+genreflexCommand = "genreflex"
+# Output paths for '--stats-json' and '--profile'.
+statsJson = None
+profileOutput = None
 
-allPCMTargets = []
 
 ignored_headers = [
   # CMS things
@@ -186,20 +225,129 @@ textual_headers = [
   "CondFormats/EcalObjects/src/SerializationManual.h", #Repeatedly included
 ]
 
-# Handle command line arguments
-for arg in sys.argv[1:]:
-    if arg == "--per-header":
-        perHeaderModules = True
-        cxxmodules = True
-    elif arg == "--modules":
-        cxxmodules = True
-    elif arg == "-H":
-        printTextualHeaders = True
-    elif arg == "--nolink":
-        noLink = True
-    else:
-        print("Unknown arg: " + arg)
-        exit(1)
+# Set of paths that also contains all paths that end with one of its entries
+# (e.g. '/home/me/cmssw/FWCore/Utilities/src/Guid.h' is in
+# SuffixSet(['FWCore/Utilities/src/Guid.h'])). Lookups only check the suffixes
+# of the path that start after a '/', so they don't depend on the number of entries.
+class SuffixSet:
+    def __init__(self, entries):
+        self.entries = set(entries)
+
+    def __contains__(self, path):
+        if path in self.entries:
+            return True
+        i = path.find("/")
+        while i != -1:
+            if path[i + 1:] in self.entries:
+                return True
+            i = path.find("/", i + 1)
+        return False
+
+ignored_header_set = SuffixSet(ignored_headers)
+textual_header_set = set(textual_headers)
+
+# Returns the SuffixSet of the sources that must not be combined with other
+# sources in unity builds (e.g. because of clashing names in anonymous
+# namespaces). They are listed in unity_excluded.json (source -> reason).
+def load_unity_exclusions():
+    with open(os.path.join(script_dir, "unity_excluded.json")) as f:
+        return SuffixSet(json.load(f))
+
+# Handles the given command line arguments by setting the global options above.
+def parse_args(argv):
+    global cxxmodules, perHeaderModules, printTextualHeaders, noLink, scanStats, jobs
+    global useCache, incremental, graphReport, statsJson, profileOutput
+    global makeDicts, genreflexCommand, compileCommands, ninjaBuild, onlyPackages, releasePath
+    global precompiledHeaders, unityBatchSize, pruneIncludes, usageRequirements, compilerLauncher
+    global shardedModuleMaps, pcmSchedule
+    args = iter(argv)
+    for arg in args:
+        if arg == "--per-header":
+            perHeaderModules = True
+            cxxmodules = True
+        elif arg == "--modules":
+            cxxmodules = True
+        elif arg == "--pcm-schedule":
+            pcmSchedule = True
+        elif arg == "--sharded-modulemaps":
+            shardedModuleMaps = True
+            cxxmodules = True
+        elif arg == "-H":
+            printTextualHeaders = True
+        elif arg == "--nolink":
+            noLink = True
+        elif arg == "--graph-report":
+            graphReport = True
+        elif arg == "--compile-commands":
+            compileCommands = True
+        elif arg == "--ninja":
+            ninjaBuild = True
+        elif arg == "--dicts":
+            makeDicts = True
+        elif arg == "--pch":
+            precompiledHeaders = True
+        elif arg == "--prune-includes":
+            pruneIncludes = True
+        elif arg == "--usage-requirements":
+            usageRequirements = True
+        elif arg == "--unity":
+            try:
+                unityBatchSize = int(next(args))
+            except (ValueError, StopIteration):
+                unityBatchSize = 0
+            if unityBatchSize < 1:
+                print("--unity expects the number of sources per batch (at least 1)")
+                exit(1)
+        elif arg == "--launcher":
+            try:
+                compilerLauncher = shlex.split(next(args))
+            except StopIteration:
+                print("--launcher expects a command (e.g. ccache)")
+                exit(1)
+        elif arg.startswith("--genreflex="):
+            genreflexCommand = arg[len("--genreflex="):]
+        elif arg == "--only":
+            try:
+                value = next(args)
+            except StopIteration:
+                print("--only expects a comma separated list of packages")
+                exit(1)
+            onlyPackages = [p.strip("/") for p in value.split(",") if p.strip("/")]
+        elif arg == "--release":
+            try:
+                releasePath = os.path.realpath(next(args))
+            except StopIteration:
+                print("--release expects the path to a release")
+                exit(1)
+            if not os.path.isdir(os.path.join(releasePath, "src")):
+                print("--release expects the path to a release, but " + releasePath +
+                      " has no src/ directory")
+                exit(1)
+        elif arg == "--stats-json" or arg == "--profile":
+            try:
+                value = next(args)
+            except StopIteration:
+                print(arg + " expects an output path")
+                exit(1)
+            if arg == "--stats-json":
+                statsJson = value
+            else:
+                profileOutput = value
+        elif arg == "--incremental":
+            incremental = True
+        elif arg == "--no-cache":
+            useCache = False
+        elif arg == "--scan-stats":
+            scanStats = True
+        elif arg.startswith("-j"):
+            try:
+                jobs = int(arg[2:] if len(arg) > 2 else next(args))
+            except (ValueError, StopIteration):
+                print("-j expects the number of jobs")
+                exit(1)
+        else:
+            print("Unknown arg: " + arg)
+            exit(1)
 
 # Returns the given text without the given prefix.
 def remove_str_refix(text, prefix):
@@ -212,9 +360,215 @@ def remove_prefix(path):
     print("NOT IN CMS" + path)
     assert False
 
-# Given an XML node with a 'file' attribute and a base_directory
-# in which the BuildFile.xml containing this node,
-def get_files(node, base_dir):
+# Timers and counters for the pipeline stages and the hot helper functions.
+# Only created when '--stats-json' is used, otherwise the global `stats` is None
+# and the only cost are the `if stats:` checks next to I/O operations.
+class Stats:
+    def __init__(self):
+        # Name -> [number of calls, total seconds]
+        self.timers = {}
+        # Name -> value
+        self.counters = {}
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds, calls=1):
+        timer = self.timers.setdefault(name, [0, 0.0])
+        timer[0] += calls
+        timer[1] += seconds
+
+    # Adds the timers and counters of another Stats object (e.g. from a worker).
+    def merge(self, other):
+        for name, (calls, seconds) in other.timers.items():
+            self.add_time(name, seconds, calls)
+        for name, value in other.counters.items():
+            self.count(name, value)
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump({
+                "timers": {name: {"calls": calls, "seconds": seconds}
+                           for name, (calls, seconds) in sorted(self.timers.items())},
+                "counters": dict(sorted(self.counters.items())),
+            }, f, indent=1)
+
+stats = None
+
+# Returns a context manager that records the time spent in it as the given
+# pipeline stage.
+def phase(name):
+    if not stats:
+        return contextlib.nullcontext()
+    return timed_block(name)
+
+@contextlib.contextmanager
+def timed_block(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add_time(name, time.perf_counter() - start)
+
+def timed_function(name, function):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.add_time(name, time.perf_counter() - start)
+    return wrapper
+
+# Enables collecting statistics. The hot helper functions are wrapped with
+# timers here (instead of checking `stats` in each of them), so they have no
+# overhead when statistics are disabled.
+def enable_stats():
+    global stats
+    if stats:
+        return
+    stats = Stats()
+    for name in ["get_files", "parse_BuildFileXml"]:
+        globals()[name] = timed_function(name, globals()[name])
+    for cls, name in [(ScramTargetBase, "link"), (CMakeGenerator, "get_headers"),
+                      (CMakeGenerator, "is_obsolete")]:
+        setattr(cls, name, timed_function(name, getattr(cls, name)))
+
+# Index of the files in a package (e.g. 'FWCore/Version') that is created with a
+# single scandir pass over the package directories that contain code. It answers
+# the file globs of the BuildFile.xml files without touching the working directory
+# (which is process-global state and prevents scanning packages in threads).
+class PackageIndex:
+    # Package directories that are indexed recursively. Other directories such
+    # as interface/, data/ or python/ are only indexed by name.
+    indexed_dirs = ["src", "bin", "test", "plugins"]
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        # Relative directory (e.g. 'src/foo') -> sorted list of file names
+        self.files = {}
+        # Relative directory -> sorted list of sub-directory names
+        self.subdirs = {}
+        # Relative path -> stat_key of all indexed directories and BuildFile.xml
+        # files. They are taken before the directories are read, so they can be
+        # used for invalidating cached data created from this index.
+        self.stamps = {}
+
+        for d in [""] + self.indexed_dirs:
+            path = os.path.join(d, "BuildFile.xml")
+            self.stamps[path] = stat_key(os.path.join(base_dir, path))
+
+        subdirs = self.scan("")[0]
+        for d in self.indexed_dirs:
+            if d in subdirs:
+                self.scan_tree(d)
+
+    # Reads the given directory into the index and returns the list of its
+    # sub-directories and the set of those that are symlinks.
+    def scan(self, rel_dir):
+        path = os.path.join(self.base_dir, rel_dir)
+        key = stat_key(path)
+        if stats:
+            stats.count("dirs_scanned")
+        files = []
+        subdirs = []
+        links = set()
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                        if entry.is_symlink():
+                            links.add(entry.name)
+                    else:
+                        files.append(entry.name)
+        except OSError:
+            pass
+        files.sort()
+        subdirs.sort()
+        self.files[rel_dir] = files
+        self.subdirs[rel_dir] = subdirs
+        self.stamps[rel_dir] = key + [listing_digest(files + subdirs)]
+        return subdirs, links
+
+    # Indexes the given directory and everything below it. Symlinked directories
+    # are followed (like os.path.isfile and glob.glob do), but not into a
+    # directory that was already reached through a symlink, so symlink loops end.
+    def scan_tree(self, rel_dir):
+        seen = {os.path.realpath(os.path.join(self.base_dir, rel_dir))}
+        todo = [rel_dir]
+        while todo:
+            d = todo.pop()
+            subdirs, links = self.scan(d)
+            for subdir in subdirs:
+                path = d + "/" + subdir
+                if subdir in links:
+                    target = os.path.realpath(os.path.join(self.base_dir, path))
+                    if target in seen:
+                        continue
+                    seen.add(target)
+                todo.append(path)
+
+    def has_file(self, rel_dir, name):
+        return name in self.files.get(rel_dir, [])
+
+    # Returns all files and directories in the package that match the given
+    # glob pattern (relative to the given directory in the package). Behaves
+    # like glob.glob(pattern, recursive=True) with the working directory set
+    # to that directory.
+    def glob(self, pattern, rel_dir=""):
+        result = []
+        parts = pattern.split("/")
+        try:
+            if pattern.startswith("/") or ".." in parts:
+                raise KeyError(pattern)
+            self.match(rel_dir, "", parts, result)
+        except KeyError:
+            # The pattern reaches outside of the indexed directories.
+            return sorted(glob.glob(pattern, root_dir=os.path.join(self.base_dir, rel_dir),
+                                    recursive=True))
+        return result
+
+    def match(self, rel_dir, out_dir, parts, result):
+        part = parts[0]
+        rest = parts[1:]
+        files = self.files[rel_dir]
+        subdirs = self.subdirs[rel_dir]
+
+        if part == "**":
+            if not rest:
+                raise KeyError(part)
+            # Matches this directory and all non-hidden directories below it
+            self.match(rel_dir, out_dir, rest, result)
+            for d in subdirs:
+                if not d.startswith("."):
+                    self.match(join_rel(rel_dir, d), join_rel(out_dir, d), parts, result)
+        elif not glob.has_magic(part):
+            if rest:
+                if part in subdirs:
+                    self.match(join_rel(rel_dir, part), join_rel(out_dir, part), rest, result)
+            elif part in files or part in subdirs:
+                result.append(join_rel(out_dir, part))
+        else:
+            candidates = subdirs if rest else sorted(files + subdirs)
+            for name in candidates:
+                if name.startswith(".") and not part.startswith("."):
+                    continue
+                if not fnmatch.fnmatchcase(name, part):
+                    continue
+                if rest:
+                    self.match(join_rel(rel_dir, name), join_rel(out_dir, name), rest, result)
+                else:
+                    result.append(join_rel(out_dir, name))
+
+# Joins two relative paths in the format used by PackageIndex.
+def join_rel(a, b):
+    return a + "/" + b if a else b
+
+# Given an XML node with a 'file' attribute, the PackageIndex of the package
+# and the directory in the package (e.g. 'bin') that contains the BuildFile.xml
+# with this node, returns the paths (relative to that directory) of all files
+# referenced by this node.
+def get_files(node, index, rel_dir):
     result = []
     files = node.attrib["file"].split(",")
     # Fallback in case we use space delimiters in the file lists...
@@ -222,10 +576,7 @@ def get_files(node, base_dir):
         files = files[0].split(" ")
 
     for file in files:
-        cwd_bak = os.path.realpath(os.getcwd())
-        os.chdir(base_dir)
-        result += glob.glob(file, recursive=True)
-        os.chdir(cwd_bak)
+        result += index.glob(file, rel_dir)
 
     for child_node in node:
         if child_node.tag == "flags":
@@ -247,7 +598,24 @@ class RootDict:
     def cmake_target(self):
         return self.unique_name
     
+    # Returns the path of the dictionary that '--dicts' generated (or found up
+    # to date) in this run (see make_dicts) or None if there is none.
+    def pregenerated_file(self):
+        path = os.path.join(prefix, dicts_dir, self.cpp_file)
+        if path in pregenerated_dicts:
+            return path
+        return None
+
     def cmake_command(self):
+        pregenerated = self.pregenerated_file()
+        if pregenerated:
+            return ("add_custom_command(\n"
+                    "  OUTPUT ${CMAKE_BINARY_DIR}/" + self.cpp_file + "\n" +
+                    "  COMMAND ${CMAKE_COMMAND} -E copy " + pregenerated +
+                    " ${CMAKE_BINARY_DIR}/" + self.cpp_file + "\n" +
+                    "  DEPENDS " + pregenerated + "\n" +
+                    "  COMMENT \"Copying pre-generated ROOT dict " + self.unique_name + "\")\n")
+
         classes_arg = ""
         classes_dep = ""
         if self.classes_xml != None:
@@ -263,6 +631,24 @@ class RootDict:
               ) 
         return command
 
+    # Returns the build.ninja statement that generates the dictionary in the
+    # given build directory (see NinjaGenerator).
+    def ninja_build(self, binary_dir):
+        pregenerated = self.pregenerated_file()
+        if pregenerated:
+            return ("build " + ninja_path(binary_dir + "/" + self.cpp_file) + ": copy " +
+                    ninja_path(pregenerated) + "\n")
+
+        xml_args = []
+        xml_dep = ""
+        if self.classes_xml != None:
+            xml_args = ["-s", self.classes_xml]
+            xml_dep = " | " + ninja_path(self.classes_xml)
+
+        return ("build " + ninja_path(binary_dir + "/" + self.cpp_file) + ": genreflex " +
+                ninja_path(self.classes_h) + xml_dep + "\n" +
+                "  xml_args = " + ninja_args(xml_args) + "\n")
+
 # Abstract base class for anything that can be built by SCRAM.
 class ScramTargetBase:
     def __init__(self):
@@ -304,29 +690,74 @@ class ScramTargetBase:
         self.forwards = set()
         self.was_linked = False
         self.root_dict = None
+        # Libraries and include directories of this target itself, without
+        # the ones that link_dependencies and link add from other targets.
+        self.direct_libs = frozenset()
+        self.direct_include_dirs = frozenset()
         
     def link_dependencies(self):
-        for forward in self.forwards:
+        self.direct_libs = frozenset(self.libs)
+        self.direct_include_dirs = frozenset(self.include_dirs)
+        for forward in sorted(self.forwards):
             self.libs |= self.project.get_target(forward).libs
             self.include_dirs |= self.project.get_target(forward).include_dirs
 
-        for dependency in self.dependencies_by_name:
+        for dependency in sorted(self.dependencies_by_name):
             try:
                 target = self.project.get_target(dependency)
                 self.dependencies.add(target)
             except FileNotFoundError as e:
                 print("Warning: Dependency " + dependency + " not found!")
                 
+    # Collects the include directories and libraries of all (transitive)
+    # dependencies of this target. The dependency graph is traversed iteratively
+    # (deep dependency chains would hit the recursion limit otherwise), but in
+    # the same order as a recursive depth-first traversal. Cycles are broken by
+    # `was_linked`: a target that is still being linked contributes what it
+    # collected so far, so the dependencies are visited sorted by name to get
+    # the same result in every run.
     def link(self):
         if self.was_linked:
             return
         self.was_linked = True
-        for dependency in self.dependencies:
-            dependency.link()
-            self.include_dirs |= dependency.include_dirs
-            self.needed_libs |= dependency.libs
-            if self.is_virtual():
-                self.libs |= dependency.libs
+        self.begin_link()
+        stack = [(self, iter(self.sorted_dependencies()))]
+        while stack:
+            target, dependencies = stack[-1]
+            dependency = next(dependencies, None)
+            if dependency is None:
+                stack.pop()
+                target.end_link()
+                if stack:
+                    stack[-1][0].merge_dependency(target)
+            elif dependency.was_linked:
+                target.merge_dependency(dependency)
+            else:
+                dependency.was_linked = True
+                dependency.begin_link()
+                stack.append((dependency, iter(dependency.sorted_dependencies())))
+
+    def sorted_dependencies(self):
+        return sorted(self.dependencies, key=lambda d: d.name)
+
+    def begin_link(self):
+        # Copy the sets as they might be shared with other targets.
+        self.include_dirs = set(self.include_dirs)
+        self.needed_libs = set(self.needed_libs)
+        self.libs = set(self.libs)
+
+    def merge_dependency(self, dependency):
+        self.include_dirs |= dependency.include_dirs
+        self.needed_libs |= dependency.libs
+        if self.is_virtual():
+            self.libs |= dependency.libs
+
+    # Replaces the collected sets with shared immutable ones. Most targets end up
+    # with the same closures as other targets, so this saves a lot of memory.
+    def end_link(self):
+        self.include_dirs = self.project.intern_set(self.include_dirs)
+        self.needed_libs = self.project.intern_set(self.needed_libs)
+        self.libs = self.project.intern_set(self.libs)
 
     def is_virtual(self):
         return len(self.source_files) == 0
@@ -342,7 +773,7 @@ def get_lib_or_name_attr(node):
 
 
 class ScramModuleLibrary(ScramTargetBase):
-    def __init__(self, node, base_dir):
+    def __init__(self, node, base_dir, index):
         super().__init__()
         self.dir = base_dir
         self.name = remove_prefix(base_dir)
@@ -387,43 +818,35 @@ class ScramModuleLibrary(ScramTargetBase):
                     else:
                         print("Unknown flag type: " + str(child.attrib))
                     
-        cwd_bak = os.path.realpath(os.getcwd())
-        os.chdir(base_dir)
-        
         base_glob = "src/*"
         if self.add_subdir:
             base_glob = "src/**/*"
-        
-        self.source_files = glob.glob(base_glob+".cc", recursive=self.add_subdir)
-        self.source_files += glob.glob(base_glob+".cpp", recursive=self.add_subdir)
-        self.source_files += glob.glob(base_glob+".cxx", recursive=self.add_subdir)
-        self.source_files += glob.glob(base_glob+".c", recursive=self.add_subdir)
-        self.source_files += glob.glob(base_glob+".C", recursive=self.add_subdir)
+
+        for extension in [".cc", ".cpp", ".cxx", ".c", ".C"]:
+            self.source_files += index.glob(base_glob + extension)
 
         for s in self.source_files:
             if s.endswith("src/ReferenceTrajectory.cc"):
                 self.source_files.remove(s)
                 break
 
-        if os.path.isfile("src/classes.h") and not noLink:
+        if index.has_file("src", "classes.h") and not noLink:
             classes_xml = None
-            classes_h = os.path.realpath("src/classes.h")
-            if os.path.isfile("src/classes_def.xml"):
-                classes_xml = os.path.realpath("src/classes_def.xml")
+            classes_h = os.path.realpath(os.path.join(base_dir, "src", "classes.h"))
+            if index.has_file("src", "classes_def.xml"):
+                classes_xml = os.path.realpath(os.path.join(base_dir, "src", "classes_def.xml"))
             self.root_dict = RootDict(classes_h, classes_xml)
             self.source_files.append("${CMAKE_BINARY_DIR}/" + self.root_dict.cpp_file)
-        
-        os.chdir(cwd_bak)
 
         if not self.is_virtual():
             self.libs.add(self.symbol)
 
 
 class ScramTarget(ScramTargetBase):
-    def __init__(self, node, base_dir):
+    def __init__(self, node, base_dir, index, rel_dir):
         super().__init__()
         self.dir = base_dir
-        self.source_files = get_files(node, base_dir)
+        self.source_files = get_files(node, index, rel_dir)
 
         try:
             self.name = node.attrib["name"]
@@ -446,26 +869,27 @@ class ScramTarget(ScramTargetBase):
 
 class ScramModule:
 
-    def get_targets_from(self, base_dir, node):
+    def get_targets_from(self, base_dir, node, index, rel_dir):
         result = []
         for child in node:
             if child.tag == "bin" or child.tag == "library":
-                bin = ScramTarget(child, base_dir)
+                bin = ScramTarget(child, base_dir, index, rel_dir)
                 result.append(bin)
             # We no longer handle the deprecated environment XML tag
             #if child.tag == "environment":
             #    result += self.get_targets_from(base_dir, child)
         return result
 
-    def parse_directory(self, base_dir):
+    # Parses the BuildFile.xml in the given sub-directory of the package (e.g. 'bin').
+    def parse_directory(self, index, rel_dir):
         result = []
-        file_path = base_dir + "BuildFile.xml"
-        if os.path.isfile(file_path):
-            xml = parse_BuildFileXml(file_path)
-            result += self.get_targets_from(base_dir, xml)
+        base_dir = self.base_dir + os.sep + rel_dir + os.sep
+        if index.has_file(rel_dir, "BuildFile.xml"):
+            xml = parse_BuildFileXml(base_dir + "BuildFile.xml")
+            result += self.get_targets_from(base_dir, xml, index, rel_dir)
         return result
 
-    def __init__(self, name, base_dir, node):
+    def __init__(self, name, base_dir, node, index=None):
         self.base_dir = base_dir
         #print(base_dir)
         assert(len(base_dir.split("/")) == 2)
@@ -474,12 +898,15 @@ class ScramModule:
         self.name = self.base_dir.replace("/", "_")
         self.targets = []
 
-        self.main_lib = ScramModuleLibrary(node, base_dir)
+        if index is None:
+            index = PackageIndex(base_dir)
+
+        self.main_lib = ScramModuleLibrary(node, base_dir, index)
         self.targets = [self.main_lib]
 
-        self.binaries = self.parse_directory(base_dir + os.sep + "bin" + os.sep)
-        self.tests = self.parse_directory(base_dir + os.sep + "test" + os.sep)
-        self.plugins = self.parse_directory(base_dir + os.sep + "plugins" + os.sep)
+        self.binaries = self.parse_directory(index, "bin")
+        self.tests = self.parse_directory(index, "test")
+        self.plugins = self.parse_directory(index, "plugins")
 
         self.targets += self.binaries
         self.targets += self.tests
@@ -525,6 +952,27 @@ class ScramProject:
 
             self.add_target(m)
 
+    # Adds the packages of a base release (see load_release) that aren't part
+    # of this project as external targets, so the local packages link against
+    # the prebuilt libraries of the release instead of building them. Returns
+    # the number of added packages.
+    def add_release(self, release):
+        added = 0
+        for name, package in sorted(release["packages"].items()):
+            if name.lower() in self.targets:
+                continue
+            m = ScramTargetBase()
+            m.name = name
+            m.external = True
+            m.include_dirs |= set(release["include_dirs"])
+            m.libs |= set(package["libs"])
+            # Like for local packages, link() collects the include directories
+            # and libraries of the dependencies.
+            m.dependencies_by_name |= set(package["uses"])
+            self.add_target(m)
+            added += 1
+        return added
+
     def __init__(self):
         # List of all modules in this project
         self.modules = []
@@ -533,6 +981,8 @@ class ScramProject:
         self.targets = {}
         # Dictionary with the format "subsystem-name" -> [module1, module2]
         self.subsystems = {}
+        # Set of all distinct frozensets created by `intern_set`
+        self.closures = {}
         # Create builtin targets
         self.init_builtin()
 
@@ -554,6 +1004,17 @@ class ScramProject:
         for target in module.targets:
             self.add_target(target)
 
+    # Returns a frozenset with the content of the given set. Equal sets are
+    # only stored once, and so are the strings in them.
+    def intern_set(self, values):
+        result = frozenset(values)
+        existing = self.closures.get(result)
+        if existing is not None:
+            return existing
+        result = frozenset(sys.intern(value) for value in result)
+        self.closures[result] = result
+        return result
+
     def add_target(self, target):
         assert isinstance(target, ScramTargetBase)
         target.project = self
@@ -574,6 +1035,8 @@ def parse_BuildFileXml(path):
     f = open(path)
     try:
         data = f.read().strip()
+        if stats:
+            stats.count("bytes_read", len(data))
         data = "<build>" + data + "</build>"
         root = ET.fromstring(data)
         # Manually copy all global <use> not inside a <bin>/<library> tag
@@ -593,25 +1056,1050 @@ def parse_BuildFileXml(path):
         return None
 
 
+# Top-level directories of a SCRAM project that never contain packages (e.g.
+# the SCRAM work area or a CMake build directory) and are therefore not scanned.
+ignored_scan_dirs = {".git", "tmp", "external", "build", "cfipython", "config", "logs", "objs"}
+
+# Returns the names of all sub-directories of the given directory that
+# could contain SCRAM code (i.e. not hidden or in `ignored`), sorted by name.
+# Directories that can't be read (e.g. on AFS) are skipped like os.walk does.
+def scan_subdirs(path, ignored=()):
+    if stats:
+        stats.count("dirs_scanned")
+    result = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith(".") or entry.name in ignored:
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        result.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        return []
+    result.sort()
+    return result
+
+# Finds all packages (e.g. 'FWCore/Version') in the SCRAM project in the given
+# directory that have a BuildFile.xml. As packages are always exactly at the
+# 'subsystem/package' depth, we never descend deeper than that (unlike a full
+# os.walk that would also go through all src/, data/, python/... directories).
+# Returns the list of package directories and the number of directories visited.
+def scan_packages(top="."):
+    packages = []
+    visited = 1
+    for subsystem in scan_subdirs(top, ignored_scan_dirs):
+        subsystem_path = os.path.join(top, subsystem)
+        visited += 1
+        # Skip CMake build directories that the user created in the project root.
+        if os.path.isfile(os.path.join(subsystem_path, "CMakeCache.txt")):
+            continue
+        for package in scan_subdirs(subsystem_path):
+            visited += 1
+            try:
+                with os.scandir(os.path.join(subsystem_path, package)) as it:
+                    for entry in it:
+                        if entry.name == "BuildFile.xml" and entry.is_file():
+                            packages.append(subsystem + "/" + package)
+                            break
+            except OSError:
+                continue
+    return packages, visited
+
+# Returns True iff the given path (e.g. 'FWCore/Version') is a package directory.
+def is_package_dir(path):
+    return path.count("/") == 1 and os.path.isfile(os.path.join(path, "BuildFile.xml"))
+
+# Counts the directories a full os.walk of the project would visit. Only used
+# for comparing the package scanner against a full walk with '--scan-stats'.
+def count_walk_dirs(top="."):
+    return sum(1 for _ in os.walk(top))
+
 # Given the specific module root directory (e.g. '~/CERN/cmssw/FWCore/Version') and the full path
 # to a BuildFile.xml inside this directory (e.g. '~/CERN/cmssw/FWCore/Version/BuildFile.xml'),
 # this function will configure a ScramModule.
-def handle_BuildFileXml(root, path):
+def handle_BuildFileXml(root, path, index=None):
     rel_path = remove_prefix(root)
     node = parse_BuildFileXml(path)
-    return ScramModule(rel_path, root, node)
+    return ScramModule(rel_path, root, node, index)
+
+# Returns the [mtime, size] of the given path or [None, None] if it doesn't exist.
+def stat_key(path):
+    if stats:
+        stats.count("files_stated")
+    try:
+        st = os.stat(path)
+        return [st.st_mtime_ns, st.st_size]
+    except OSError:
+        return [None, None]
+
+# Returns the stat() results of all files and directories whose modification
+# invalidates the ScramModule parsed from the given PackageIndex. Adding or
+# removing a source file changes the mtime of its directory, so we don't need
+# to stat the source files themselves.
+def package_stamp(index):
+    return [[os.path.join(index.base_dir, path)] + key for path, key in index.stamps.items()]
+
+# Name of the module map of a package written with '--sharded-modulemaps'
+# (next to its interface/ directory).
+module_map_shard = "interface.modulemap"
+
+# Files that scram2cmake writes into the package directories. They are ignored
+# when checking whether the content of a directory changed.
+generated_file_names = {"CMakeLists.txt", "moduletrigger.cxx", module_map_shard}
+
+# Returns a digest of the given directory entries (without generated files).
+def listing_digest(names):
+    names = sorted(name for name in names if name not in generated_file_names)
+    return hashlib.sha1("\0".join(names).encode()).hexdigest()
+
+# Checks that none of the files and directories in the given stamp changed
+# since the stamp was created. Directories (the entries with a listing digest)
+# whose mtime changed are listed again, as writing our own CMakeLists.txt files
+# into them also changes their mtime. Their new mtime is stored in the stamp.
+# Returns whether the stamp is still valid and whether it was updated.
+def check_stamp(stamp):
+    updated = False
+    for entry in stamp:
+        key = stat_key(entry[0])
+        if key == entry[1:3]:
+            continue
+        if len(entry) < 4 or key[0] is None or entry[1] is None:
+            return False, False
+        try:
+            names = os.listdir(entry[0])
+        except OSError:
+            return False, False
+        if listing_digest(names) != entry[3]:
+            return False, False
+        entry[1:3] = key
+        updated = True
+    return True, updated
+
+# Persistent cache stored in the root of the SCRAM project. It keeps the parsed
+# ScramModule of each package (pickled) together with the stamp of the files
+# it was created from, so unchanged packages don't have to be parsed again.
+class ProjectCache:
+    path = ".scram2cmake.cache"
+    # Bump this whenever the format of the stored data changes.
+    version = 2
+    # Seconds to wait for another scram2cmake run that has the cache locked.
+    timeout = 60
+
+    def __init__(self):
+        self.db = None
+        try:
+            self.open()
+        except sqlite3.OperationalError:
+            # E.g. 'database is locked', which doesn't mean the file is broken.
+            if self.db:
+                self.db.close()
+            raise
+        except sqlite3.DatabaseError:
+            print("Cache is corrupt, recreating " + self.path)
+            self.db.close()
+            os.remove(self.path)
+            self.open()
+
+    def open(self):
+        self.db = sqlite3.connect(self.path, timeout=self.timeout)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS packages "
+                        "(path TEXT PRIMARY KEY, stamp TEXT, module BLOB)")
+        # Command line and stamp of the last successful genreflex run for each
+        # src/ directory with a ROOT dictionary.
+        self.db.execute("CREATE TABLE IF NOT EXISTS dictionaries "
+                        "(dir TEXT PRIMARY KEY, command TEXT, stamp TEXT)")
+        # Results of CMakeGenerator.is_obsolete. They only depend on the content
+        # of the header, so they survive changes of the settings below.
+        self.db.execute("CREATE TABLE IF NOT EXISTS obsolete_headers "
+                        "(path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, obsolete INTEGER)")
+        # Include directives of the files read by an IncludeScanner.
+        self.db.execute("CREATE TABLE IF NOT EXISTS include_directives "
+                        "(path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, directives TEXT)")
+        # Signatures of the header sets of the module maps written with
+        # '--sharded-modulemaps' (see CMakeGenerator.module_map_signature).
+        self.db.execute("CREATE TABLE IF NOT EXISTS module_maps "
+                        "(path TEXT PRIMARY KEY, signature TEXT)")
+        # Results of index_release for each base release used with '--release'.
+        self.db.execute("CREATE TABLE IF NOT EXISTS releases "
+                        "(path TEXT PRIMARY KEY, stamp TEXT, release TEXT)")
+        # Pickled modules are only valid for the same script, options and
+        # project location (they contain absolute paths, e.g. of classes.h).
+        settings = json.dumps([self.version, __name__, noLink, os.path.realpath(prefix),
+                               os.stat(os.path.realpath(__file__)).st_mtime_ns])
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'settings'").fetchone()
+        if row is None or row[0] != settings:
+            self.db.execute("DELETE FROM packages")
+            self.db.execute("DELETE FROM module_maps")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('settings', ?)", (settings,))
+
+    # Returns the cached ScramModule for the given package or None if there is
+    # no valid entry for it.
+    def get_module(self, root):
+        row = self.db.execute("SELECT stamp, module FROM packages WHERE path = ?",
+                              (root,)).fetchone()
+        if row is None:
+            return None
+        stamp = json.loads(row[0])
+        valid, updated = check_stamp(stamp)
+        if not valid:
+            return None
+        if updated:
+            self.db.execute("UPDATE packages SET stamp = ? WHERE path = ?",
+                            (json.dumps(stamp), root))
+        return pickle.loads(row[1])
+
+    def put_module(self, root, stamp, module):
+        self.db.execute("INSERT OR REPLACE INTO packages VALUES (?, ?, ?)",
+                        (root, json.dumps(stamp), pickle.dumps(module)))
+
+    # Returns a dict with path -> [mtime, size, is obsolete] for all headers
+    # checked by CMakeGenerator.is_obsolete.
+    def get_obsolete_headers(self):
+        result = {}
+        for path, mtime, size, obsolete in self.db.execute("SELECT * FROM obsolete_headers"):
+            result[path] = [mtime, size, bool(obsolete)]
+        return result
+
+    def put_obsolete_headers(self, headers):
+        self.db.executemany("INSERT OR REPLACE INTO obsolete_headers VALUES (?, ?, ?, ?)",
+                            [(path,) + tuple(value) for path, value in headers.items()])
+
+    # Returns a dict with path -> signature for all module maps.
+    def get_module_maps(self):
+        return dict(self.db.execute("SELECT * FROM module_maps"))
+
+    def put_module_maps(self, module_maps):
+        self.db.executemany("INSERT OR REPLACE INTO module_maps VALUES (?, ?)",
+                            list(module_maps.items()))
+
+    # Returns a dict with src directory -> (command, stamp) for all dictionaries.
+    def get_dictionaries(self):
+        result = {}
+        for path, command, stamp in self.db.execute("SELECT * FROM dictionaries"):
+            result[path] = (json.loads(command), json.loads(stamp))
+        return result
+
+    def put_dictionary(self, path, command, stamp):
+        self.db.execute("INSERT OR REPLACE INTO dictionaries VALUES (?, ?, ?)",
+                        (path, json.dumps(command), json.dumps(stamp)))
+
+    def remove_dictionary(self, path):
+        self.db.execute("DELETE FROM dictionaries WHERE dir = ?", (path,))
+
+    # Returns a dict with path -> [mtime, size, directives] (see IncludeScanner).
+    def get_include_directives(self):
+        result = {}
+        for path, mtime, size, directives in self.db.execute("SELECT * FROM include_directives"):
+            result[path] = [mtime, size, directives]
+        return result
+
+    def put_include_directives(self, files):
+        self.db.executemany("INSERT OR REPLACE INTO include_directives VALUES (?, ?, ?, ?)",
+                            [(path, mtime, size, json.dumps(directives))
+                             for path, (mtime, size, directives) in files.items()])
+
+    # Returns the cached index of the release at the given path or None if
+    # there is no valid entry for it.
+    def get_release(self, path):
+        row = self.db.execute("SELECT stamp, release FROM releases WHERE path = ?",
+                              (path,)).fetchone()
+        if row is None or not check_stamp(json.loads(row[0]))[0]:
+            return None
+        return json.loads(row[1])
+
+    def put_release(self, path, stamp, release):
+        self.db.execute("INSERT OR REPLACE INTO releases VALUES (?, ?, ?)",
+                        (path, json.dumps(stamp), json.dumps(release)))
+
+    # Removes all packages that are not in the given list (e.g. deleted packages).
+    def prune_modules(self, packages):
+        known = set(packages)
+        for (root,) in self.db.execute("SELECT path FROM packages").fetchall():
+            if root not in known:
+                self.db.execute("DELETE FROM packages WHERE path = ?", (root,))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+# Returns the ProjectCache or None if the cache is disabled. If the cache can't
+# be opened (e.g. because another run keeps it locked for too long), the rest of
+# this run continues without it.
+def open_cache():
+    global useCache
+    if not useCache:
+        return None
+    try:
+        return ProjectCache()
+    except sqlite3.OperationalError as e:
+        print("Can't use the cache " + ProjectCache.path + " (" + str(e) + "), continuing without it")
+        useCache = False
+        return None
+
+# Parses the BuildFile.xml of the given package directory (e.g. 'FWCore/Version').
+# This is the unit of work that is distributed over the worker processes with '-j'.
+# Returns the stamp of the package (created before parsing, so that changes
+# during parsing invalidate the cache entry) and the parsed ScramModule.
+def parse_package(root):
+    index = PackageIndex(root)
+    stamp = package_stamp(index) if useCache else None
+    return stamp, handle_BuildFileXml(root, os.path.join(root, "BuildFile.xml"), index)
+
+# Like parse_package, but also returns the statistics collected while parsing,
+# as worker processes can't update the statistics of the main process.
+def parse_package_in_worker(root):
+    global stats
+    if stats is None:
+        return parse_package(root) + (None,)
+    stats = Stats()
+    return parse_package(root) + (stats,)
+
+# Sets the options used while parsing in a worker process (which doesn't
+# necessarily inherit the global state of this process).
+def init_worker(no_link, use_cache, collect_stats):
+    global noLink, useCache
+    noLink = no_link
+    useCache = use_cache
+    if collect_stats:
+        enable_stats()
+
+# Parses all given packages and returns the resulting ScramModules. The modules
+# are returned in the order of the given package list, so the generated output
+# doesn't depend on the number of jobs or on which worker finished first.
+# Cache entries of other packages are removed if `prune` is True.
+def parse_packages(packages, prune=True):
+    cache = open_cache()
+    result = [None] * len(packages)
+    # Indexes of the packages that aren't in the cache
+    todo = []
+    for i, root in enumerate(packages):
+        if cache:
+            result[i] = cache.get_module(root)
+        if result[i] is None:
+            todo.append(i)
+    if stats:
+        stats.count("cache_hits", len(packages) - len(todo))
+        stats.count("packages_parsed", len(todo))
+
+    roots = [packages[i] for i in todo]
+    if jobs <= 1 or len(roots) <= 1:
+        parsed = [parse_package(root) for root in roots]
+    else:
+        # The ScramModules and their targets are plain objects that are pickled
+        # back to this process. They don't reference the ScramProject until
+        # ScramProject.add_module is called.
+        with multiprocessing.Pool(jobs, init_worker, (noLink, useCache, bool(stats))) as pool:
+            chunksize = max(1, len(roots) // (jobs * 4))
+            parsed = []
+            for stamp, module, worker_stats in pool.map(parse_package_in_worker, roots, chunksize):
+                parsed.append((stamp, module))
+                if worker_stats:
+                    stats.merge(worker_stats)
+
+    for i, (stamp, module) in zip(todo, parsed):
+        result[i] = module
+        if cache and module:
+            cache.put_module(packages[i], stamp, module)
+
+    if cache:
+        if prune:
+            cache.prune_modules(packages)
+        cache.close()
+    return result
+
+# Parses the given packages and all packages they (transitively) depend on,
+# without scanning the rest of the project. The dependencies are found through
+# the `dependencies_by_name` of the parsed targets, so each round parses the
+# packages that were first reached in the previous one. Dependencies that aren't
+# package directories (e.g. externals) are resolved as usual by the ScramProject.
+# Returns the sorted package directories and their ScramModules.
+def parse_package_closure(roots):
+    modules = {}
+    todo = sorted(set(root for root in roots if is_package_dir(root)))
+    while todo:
+        names = set()
+        for root, module in zip(todo, parse_packages(todo, prune=False)):
+            modules[root] = module
+            if module:
+                for target in module.targets:
+                    names |= target.dependencies_by_name
+        todo = sorted(name for name in names if name not in modules and is_package_dir(name))
+    packages = sorted(modules)
+    return packages, [modules[root] for root in packages]
+
+# Writes the given data to the file at the given path. The data is written to a
+# temporary file first which then replaces the target file, so other processes
+# (or an interrupted run) never see a partially written file. The whole content
+# is written with a single write call (unless the OS only accepts part of it).
+def write_file_atomic(path, data):
+    tmp_path = path + ".tmp" + str(os.getpid())
+    data = memoryview(data.encode())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+    os.close(fd)
+    os.replace(tmp_path, path)
+
+# Collects the content of all generated files in memory and writes them to disk
+# in `commit`, each file atomically and in one piece. The files are written
+# directory by directory, which keeps the directory metadata operations of
+# network filesystems local. With '--incremental', a manifest with the hash, mtime and size
+# of every generated file is stored in the project root: files whose content didn't
+# change are not touched (so CMake doesn't need to re-configure them) and files that
+# are no longer generated are removed. Files that were modified since they were
+# written (e.g. by hand or by a run without '--incremental') are written again.
+class OutputTree:
+    manifest_path = ".scram2cmake.manifest"
+
+    def __init__(self):
+        # Path -> StringIO with the content of that file.
+        self.files = {}
+        # Paths of generated files that are already up to date (see keep).
+        self.kept = set()
+
+    # Returns the stream for the file at the given path. Multiple calls for the
+    # same path return the same stream, so the content is appended.
+    def open(self, path):
+        path = os.path.normpath(path)
+        if path not in self.files:
+            self.files[path] = io.StringIO()
+        return self.files[path]
+
+    # Marks the file at the given path as generated without writing it again,
+    # so '--incremental' doesn't remove it.
+    def keep(self, path):
+        self.kept.add(os.path.normpath(path))
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    # Returns the paths of all files grouped by their directory (both sorted).
+    def paths_by_directory(self):
+        directories = {}
+        for path in self.files:
+            directories.setdefault(os.path.dirname(path), []).append(path)
+        return [sorted(directories[d]) for d in sorted(directories)]
+
+    # Writes the given files (which are all in the same directory) and returns
+    # their hashes (only with '--incremental'), the number of written files and
+    # the number of written bytes.
+    def write_batch(self, paths, old_manifest):
+        hashes = {}
+        written = 0
+        written_bytes = 0
+        for path in paths:
+            data = self.files[path].getvalue()
+            if incremental:
+                digest = hashlib.sha1(data.encode()).hexdigest()
+                old = old_manifest.get(path)
+                if old == [digest] + stat_key(path):
+                    hashes[path] = old
+                    continue
+            write_file_atomic(path, data)
+            if incremental:
+                hashes[path] = [digest] + stat_key(path)
+            written += 1
+            written_bytes += len(data)
+        return hashes, written, written_bytes
+
+    def commit(self):
+        old_manifest = self.load_manifest() if incremental else {}
+        batches = self.paths_by_directory()
+        if jobs > 1 and len(batches) > 1:
+            # Writing is I/O bound, so threads are enough to have multiple
+            # writes in flight (which helps a lot on network filesystems).
+            with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                results = list(executor.map(lambda paths: self.write_batch(paths, old_manifest),
+                                            batches))
+        else:
+            results = [self.write_batch(paths, old_manifest) for paths in batches]
+
+        manifest = {}
+        written = 0
+        for hashes, count, written_bytes in results:
+            manifest.update(hashes)
+            written += count
+            if stats:
+                stats.count("files_written", count)
+                stats.count("bytes_written", written_bytes)
+
+        if not incremental:
+            return
+
+        for path in self.kept:
+            old = old_manifest.get(path)
+            if old is not None and old[1:] == stat_key(path):
+                manifest[path] = old
+            else:
+                with open(path, "rb") as f:
+                    manifest[path] = [hashlib.sha1(f.read()).hexdigest()] + stat_key(path)
+
+        removed = 0
+        for path in old_manifest:
+            if path not in manifest and os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+
+        write_file_atomic(self.manifest_path, json.dumps(manifest, indent=1, sort_keys=True))
+        print("Updated " + str(written) + " and removed " + str(removed) + " of " +
+              str(len(manifest)) + " generated files")
+
+# Finds the headers in a directory tree (e.g. 'FWCore/Version/interface/').
+# Every directory is only scanned once per run, as the same interface/ directory
+# is needed both for generating the targets and for the module map.
+class HeaderIndex:
+    extensions = (".h", ".hh", ".hpp", ".icc", ".inc")
+
+    def __init__(self):
+        # Normalized directory path -> sorted list of headers
+        self.headers = {}
+
+    # Returns the sorted list of headers in the given directory and its
+    # sub-directories. Headers in `ignored_headers` and the classes.h/headers.h
+    # files for ROOT dictionaries are not returned.
+    def get_headers(self, path):
+        key = os.path.normpath(path)
+        if key not in self.headers:
+            self.headers[key] = self.scan(path)
+        return self.headers[key]
+
+    def scan(self, path):
+        result = []
+        todo = [""]
+        while todo:
+            rel_dir = todo.pop()
+            if stats:
+                stats.count("dirs_scanned")
+            try:
+                it = os.scandir(path + rel_dir)
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    # Hidden files and directories are skipped like glob does.
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        todo.append(rel_dir + entry.name + "/")
+                        continue
+                    if not entry.name.endswith(self.extensions):
+                        continue
+                    if entry.name == "classes.h" or entry.name == "headers.h":
+                        continue
+                    header = path + rel_dir + entry.name
+                    if header in ignored_header_set:
+                        continue
+                    result.append(header)
+        result.sort()
+        return result
+
+# Dependency graph between the given targets (with resolved dependencies).
+# Each target has a weight that estimates the cost of building it (by default
+# the number of source files) which is used for the critical path analysis.
+class DependencyGraph:
+    def __init__(self, targets, weight=None):
+        if weight is None:
+            weight = lambda t: len(t.source_files) if t.built_by_cmake() else 0
+        # All targets sorted by name, so all results are deterministic.
+        self.nodes = sorted(targets, key=lambda t: t.name)
+        node_index = {}
+        for i, target in enumerate(self.nodes):
+            node_index[target] = i
+        self.weights = [weight(t) for t in self.nodes]
+        # Node index -> sorted indexes of the direct dependencies in this graph
+        self.edges = []
+        for target in self.nodes:
+            deps = [node_index[d] for d in target.dependencies if d in node_index]
+            self.edges.append(sorted(set(deps)))
+        self.compute_components()
+
+    # Computes the strongly connected components of the graph with Tarjan's
+    # algorithm (iteratively, as the graph can be deep). The components are
+    # stored in `self.components` in topological order (dependencies first) and
+    # `self.component_of` maps each node to the index of its component.
+    def compute_components(self):
+        n = len(self.nodes)
+        index = [None] * n
+        low = [0] * n
+        on_stack = [False] * n
+        stack = []
+        counter = 0
+        self.components = []
+        for root in range(n):
+            if index[root] is not None:
+                continue
+            work = [(root, 0)]
+            while work:
+                v, i = work.pop()
+                edges = self.edges[v]
+                if i == 0:
+                    index[v] = low[v] = counter
+                    counter += 1
+                    stack.append(v)
+                    on_stack[v] = True
+                else:
+                    # We return from visiting the dependency edges[i - 1]
+                    w = edges[i - 1]
+                    if on_stack[w]:
+                        low[v] = min(low[v], low[w])
+                while i < len(edges):
+                    w = edges[i]
+                    i += 1
+                    if index[w] is None:
+                        work.append((v, i))
+                        work.append((w, 0))
+                        break
+                    if on_stack[w]:
+                        low[v] = min(low[v], index[w])
+                else:
+                    if low[v] == index[v]:
+                        component = []
+                        while True:
+                            w = stack.pop()
+                            on_stack[w] = False
+                            component.append(w)
+                            if w == v:
+                                break
+                        component.sort()
+                        self.components.append(component)
+
+        self.component_of = [0] * n
+        for c, component in enumerate(self.components):
+            for v in component:
+                self.component_of[v] = c
+        self.component_weights = [sum(self.weights[v] for v in component)
+                                  for component in self.components]
+        # Component index -> sorted component indexes of its dependencies
+        self.component_edges = []
+        for component in self.components:
+            deps = set()
+            for v in component:
+                for w in self.edges[v]:
+                    deps.add(self.component_of[w])
+            deps.discard(self.component_of[component[0]])
+            self.component_edges.append(sorted(deps))
+
+    # Returns the targets in an order in which they can be built (dependencies
+    # first). Targets in a cycle are returned next to each other.
+    def topological_order(self):
+        return [self.nodes[v] for component in self.components for v in component]
+
+    # Returns all dependency cycles as lists of targets.
+    def cycles(self):
+        result = []
+        for component in self.components:
+            v = component[0]
+            if len(component) > 1 or v in self.edges[v]:
+                result.append([self.nodes[w] for w in component])
+        return result
+
+    # Returns the cost of the most expensive chain of dependent targets and the
+    # components in that chain (starting with the first one that has to be built).
+    # The component edge `removed_edge` is ignored if given.
+    def longest_path(self, removed_edge=None):
+        finish = []
+        previous = []
+        for c, deps in enumerate(self.component_edges):
+            best = None
+            for d in deps:
+                if (c, d) == removed_edge:
+                    continue
+                if best is None or finish[d] > finish[best]:
+                    best = d
+            previous.append(best)
+            finish.append(self.component_weights[c] + (0 if best is None else finish[best]))
+
+        if not finish:
+            return 0, []
+        end = max(range(len(finish)), key=lambda c: finish[c])
+        path = []
+        c = end
+        while c is not None:
+            path.append(c)
+            c = previous[c]
+        path.reverse()
+        return finish[end], path
+
+    # Returns two dicts target -> cost: the cost of the most expensive chain of
+    # dependent targets through the target, and of the most expensive chain
+    # that starts with it (the target and the targets that depend on it). The
+    # latter is the least time the build needs once the target is started, so
+    # targets with a higher one should be started first.
+    def chain_costs(self):
+        head = []
+        for c, deps in enumerate(self.component_edges):
+            head.append(self.component_weights[c] + max((head[d] for d in deps), default=0))
+        # The components are in topological order, so all components that
+        # depend on a component are visited before it.
+        tail = [0] * len(self.components)
+        for c in reversed(range(len(self.components))):
+            tail[c] += self.component_weights[c]
+            for d in self.component_edges[c]:
+                tail[d] = max(tail[d], tail[c])
+        chains = {}
+        tails = {}
+        for v, target in enumerate(self.nodes):
+            c = self.component_of[v]
+            chains[target] = head[c] + tail[c] - self.component_weights[c]
+            tails[target] = tail[c]
+        return chains, tails
+
+    # Returns the first (target, dependency) pair that connects the two components.
+    def edge_between(self, c, dep):
+        for v in self.components[c]:
+            for w in self.edges[v]:
+                if self.component_of[w] == dep:
+                    return self.nodes[v], self.nodes[w]
+
+    # Returns the critical path as (cost, list of targets) and, for every
+    # dependency on that path, how much shorter the critical path would get
+    # without this dependency as (saving, target, dependency) tuples, sorted by saving.
+    def critical_path(self):
+        cost, path = self.longest_path()
+        savings = []
+        for dep, c in zip(path, path[1:]):
+            new_cost, new_path = self.longest_path((c, dep))
+            target, dependency = self.edge_between(c, dep)
+            savings.append((cost - new_cost, target, dependency))
+        savings.sort(key=lambda s: (-s[0], s[1].name, s[2].name))
+        targets = [self.nodes[v] for c in path for v in self.components[c]]
+        return cost, targets, savings
+
+    # Writes a JSON report with the build order, cycles and critical path.
+    def write_json(self, path):
+        cost, critical, savings = self.critical_path()
+        total = sum(self.weights)
+        report = {
+            "targets": len(self.nodes),
+            "dependencies": sum(len(e) for e in self.edges),
+            "total_cost": total,
+            "critical_path_cost": cost,
+            "max_parallelism": (total / cost) if cost else 0,
+            "critical_path": [t.name for t in critical],
+            "critical_dependencies": [
+                {"target": t.name, "dependency": d.name, "saving": saving}
+                for saving, t, d in savings],
+            "cycles": [[t.name for t in cycle] for cycle in self.cycles()],
+            "build_order": [t.name for t in self.topological_order()],
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1)
+
+    # Writes the graph in the DOT format. Targets on the critical path are red
+    # and targets in dependency cycles are orange.
+    def write_dot(self, path):
+        cost, critical, savings = self.critical_path()
+        critical = set(critical)
+        in_cycle = set(t for cycle in self.cycles() for t in cycle)
+        with open(path, "w") as f:
+            f.write("digraph dependencies {\n")
+            for target, weight in zip(self.nodes, self.weights):
+                f.write("  \"" + target.name + "\" [label=\"" + target.name +
+                        "\\n" + str(weight) + "\"")
+                if target in critical:
+                    f.write(" color=red")
+                elif target in in_cycle:
+                    f.write(" color=orange")
+                f.write("];\n")
+            for target, edges in zip(self.nodes, self.edges):
+                for w in edges:
+                    dependency = self.nodes[w]
+                    f.write("  \"" + target.name + "\" -> \"" + dependency.name + "\"")
+                    if target in critical and dependency in critical:
+                        f.write(" [color=red]")
+                    f.write(";\n")
+            f.write("}\n")
+
+# Writes the dependency graph report of the targets built in the given project
+# to 'scram2cmake-graph.json' and 'scram2cmake-graph.dot'.
+def write_graph_report(project):
+    targets = [t for module in project.modules for t in module.targets]
+    graph = DependencyGraph(targets)
+    graph.write_json("scram2cmake-graph.json")
+    graph.write_dot("scram2cmake-graph.dot")
+    cost, critical, savings = graph.critical_path()
+    print("Dependency graph: " + str(len(graph.nodes)) + " targets, " +
+          str(len(graph.cycles())) + " cycles, critical path of " + str(len(critical)) +
+          " targets with cost " + str(cost) + " of " + str(sum(graph.weights)))
+
+include_regex = re.compile(rb'^[ \t]*#[ \t]*include[ \t]*([<"])([^">]+)[">]', re.MULTILINE)
+
+# Finds the files included by source files and headers. The include directives
+# of each file are only parsed once per run.
+class IncludeScanner:
+    # `cached` is a dict with path -> [mtime, size, directives] from a previous
+    # run (see ProjectCache.get_include_directives). If it's given, files that
+    # didn't change aren't read again, and the directives of all files that
+    # were read are stored in `changed` in the same format.
+    def __init__(self, cached=None):
+        # Path -> list of (name, is quoted include) of the directives in that file
+        self.directives = {}
+        # (directory of the including file or None, name, include dirs) ->
+        # (resolved path, directory it was found in)
+        self.resolved = {}
+        self.cached = cached
+        self.changed = {}
+
+    def get_directives(self, path):
+        result = self.directives.get(path)
+        if result is None:
+            key = None
+            if self.cached is not None:
+                key = stat_key(path)
+                entry = self.cached.get(path)
+                if entry is not None and entry[:2] == key:
+                    result = [tuple(d) for d in json.loads(entry[2])]
+                    self.directives[path] = result
+                    return result
+            result = []
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                if stats:
+                    stats.count("bytes_read", len(data))
+                for match in include_regex.finditer(data):
+                    result.append((match.group(2).decode("latin-1"), match.group(1) == b'"'))
+            except OSError:
+                pass
+            self.directives[path] = result
+            if key is not None and key[0] is not None:
+                self.changed[path] = key + [result]
+        return result
+
+    # Returns the path of the file that is included with the given name from the
+    # given file and the directory it was found in, or (None, None) if it's not
+    # found in the given include directories. Quoted includes are also searched
+    # relative to the including file.
+    def find(self, name, including_file, quoted, include_dirs):
+        directory = os.path.dirname(including_file) if quoted else None
+        key = (directory, name, include_dirs)
+        if key in self.resolved:
+            return self.resolved[key]
+        result = (None, None)
+        candidates = ([directory] if quoted else []) + list(include_dirs)
+        for d in candidates:
+            path = os.path.normpath(os.path.join(d, name))
+            if os.path.isfile(path):
+                result = (path, d)
+                break
+        self.resolved[key] = result
+        return result
+
+    # Returns the path of the file that is included with the given name from the
+    # given file or None if it's not found in the given include directories.
+    def resolve(self, name, including_file, quoted, include_dirs):
+        return self.find(name, including_file, quoted, include_dirs)[0]
+
+    # Returns the set of include directories (from the given tuple) in which
+    # the files included by the given files were found, following all includes
+    # transitively.
+    def used_include_dirs(self, paths, include_dirs):
+        used = set()
+        seen = set(paths)
+        todo = list(paths)
+        while todo:
+            current = todo.pop()
+            for name, quoted in self.get_directives(current):
+                included, directory = self.find(name, current, quoted, include_dirs)
+                if included is None:
+                    continue
+                used.add(directory)
+                if included not in seen:
+                    seen.add(included)
+                    todo.append(included)
+        return used
+
+    # Returns the sorted list of all files that are (transitively) included by
+    # the given file and can be found in the given include directories (a tuple).
+    def transitive_includes(self, path, include_dirs):
+        result = set()
+        todo = [path]
+        while todo:
+            current = todo.pop()
+            for name, quoted in self.get_directives(current):
+                included = self.resolve(name, current, quoted, include_dirs)
+                if included is not None and included not in result:
+                    result.add(included)
+                    todo.append(included)
+        return sorted(result)
+
+# Returns True iff the file at the given path contains an '#error' but no '#if'
+# (which is the case for headers that only exist to tell people to use another
+# header). The file is read in binary mode in chunks, and reading stops as soon
+# as an '#if' is found (which is usually near the top because of include guards).
+def scan_obsolete(path):
+    found_error = False
+    tail = b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                return found_error
+            if stats:
+                stats.count("bytes_read", len(chunk))
+            # Keep the end of the last chunk for directives split between chunks.
+            data = tail + chunk
+            if b"#if" in data:
+                return False
+            if b"#error" in data:
+                found_error = True
+            tail = data[-5:]
+
+# Returns the given argument as a quoted CMake argument.
+def cmake_quote(arg):
+    return '"' + re.sub(r'([\\"$;])', r'\\\1', arg) + '"'
+
+# Returns the compiler flags that are used for all C++ sources in the project
+# (as a list of space separated flag groups). `binary_dir` is the directory that
+# contains the build output (e.g. '${CMAKE_BINARY_DIR}').
+def global_cxx_flags(binary_dir):
+    result = ["-pthread -march=native -Wno-attributes -Wno-deprecated-declarations "
+              "-Wno-deprecated-register -Wno-null-dereference -std=c++14"]
+    if cxxmodules:
+        result.append("-fmodules -Wno-module-import-in-extern-c -Xclang -fmodules-local-submodule-visibility "
+                      "-Xclang -fdisable-module-hash -fPIC -ivfsoverlay " + prefix + "libs.overlay.yaml "
+                      "-fmodules-cache-path=" + binary_dir + "/pcms/")
+    if printTextualHeaders:
+        result.append("-H")
+    return result
+
+# Returns the sorted include directories that are used for all targets in the
+# project (in addition to the project root and /usr/include/). With
+# '--prune-includes' there are none, as each target only gets the include
+# directories it uses, and with '--usage-requirements' CMake propagates them.
+def global_include_dirs(project):
+    if pruneIncludes or usageRequirements:
+        return []
+    include_paths = set()
+    for module in project.modules:
+        for target in module.targets:
+            include_paths |= target.include_dirs
+    return sorted(include_paths)
+
+# Replaces the include directories of all targets with the ones that their
+# sources (and the headers they include, transitively) are actually found in.
+# The include directives of the files are stored in the ProjectCache, so only
+# changed files are read again. Prints how many -I arguments the compiles
+# get before and after.
+def prune_include_dirs(project):
+    cache = open_cache()
+    scanner = IncludeScanner(cache.get_include_directives() if cache else None)
+    header_index = HeaderIndex()
+
+    targets = [t for module in project.modules for t in module.targets if t.built_by_cmake()]
+    all_dirs = set()
+    for target in targets:
+        all_dirs |= target.include_dirs
+
+    # Number of -I arguments of all compiles (each source is compiled with the
+    # project root, /usr/include/ and the include directories).
+    compiles = 0
+    before = 0
+    after = 0
+    for target in targets:
+        paths = [os.path.join(prefix, target.dir, s) for s in target.source_files
+                 if not s.startswith("${CMAKE_BINARY_DIR}")]
+        if target.root_dict != None:
+            paths.append(target.root_dict.classes_h)
+        # The PCM of a library contains all its interface headers.
+        if cxxmodules and target is target.module.main_lib:
+            paths += [os.path.join(prefix, h) for h in header_index.get_headers(target.dir + "/interface/")]
+        paths = [os.path.normpath(path) for path in paths]
+
+        include_dirs = (prefix, "/usr/include/") + tuple(sorted(target.include_dirs))
+        used = scanner.used_include_dirs(paths, include_dirs)
+        pruned = target.include_dirs & used
+        compiles += len(target.source_files)
+        before += len(target.source_files) * (2 + len(all_dirs))
+        after += len(target.source_files) * (2 + len(pruned))
+        target.include_dirs = project.intern_set(pruned)
+
+    if cache:
+        cache.put_include_directives(scanner.changed)
+        cache.close()
+    print("Pruned include directories of " + str(len(targets)) + " targets: " +
+          str(before) + " -I arguments before, " + str(after) + " after" +
+          (" (%.1f -> %.1f per compile)" % (before / compiles, after / compiles) if compiles else ""))
+
+# Returns the include arguments that are used for all targets in the project.
+def global_include_args(project):
+    return ["-I" + prefix, "-I/usr/include/"] + ["-I" + d for d in global_include_dirs(project)]
+
+# Returns the compiler arguments that the given target adds to the global ones.
+# Like CMake, we don't repeat include directories that are in `global_args`.
+def target_compile_args(target, global_args):
+    result = ["-I" + d for d in sorted(target.include_dirs) if "-I" + d not in global_args]
+    if not noLink:
+        result += shlex.split(target.defines) + shlex.split(target.cxx_flags)
+    return result
+
+# Returns the name of the CMake target of the given target with
+# '--usage-requirements'. External targets are imported as 'ext_<name>'.
+def usage_target_name(target):
+    if target.external:
+        return "ext_" + re.sub("[^a-zA-Z0-9_]", "_", target.name)
+    return target.symbol
+
+# Headers are only precompiled for targets with at least `pch_min_sources`
+# sources, and only headers that are directly included by at least
+# `pch_min_share` of these sources are candidates. At most `pch_max_headers`
+# headers (the ones whose precompilation saves the most) are used per target.
+pch_min_sources = 3
+pch_min_share = 0.5
+pch_max_headers = 8
+
+# With '--pcm-schedule', the cost of building a PCM is estimated as the bytes
+# of the headers in the interface/ directory plus `pcm_header_cost` per header.
+# PCMs that aren't on a chain costing at least `pcm_critical_share` of the
+# critical path are built in the 'pcm_background' job pool, which only gets
+# half of the cores, so the critical ones don't have to wait for them.
+pcm_header_cost = 4096
+pcm_critical_share = 0.5
 
 # Generates CMake files that represent the given ScramProject.
 class CMakeGenerator:
 
     def __init__(self, project):
         self.project = project
+        # All files are first generated in memory.
+        self.output = OutputTree()
+        self.header_index = HeaderIndex()
+        # Names of all PCM targets when using cxxmodules.
+        self.pcm_targets = []
+        # (target symbol, bytes of headers parsed without PCH, bytes saved by
+        # the PCH, {header: estimated bytes saved}) for all targets with a PCH.
+        self.pch_targets = []
+        self.include_scanner = IncludeScanner()
+        # Path -> size in bytes of all headers seen by select_precompiled_headers
+        self.file_sizes = {}
+        self.unity_excluded = load_unity_exclusions() if unityBatchSize else None
+        # PCM target -> cost of the most expensive chain of PCMs starting with it
+        # and the PCM targets in the 'pcm_background' pool (see schedule_pcms).
+        self.pcm_priorities = {}
+        self.pcm_background = set()
+        # Path -> signature of the module map shards written in this run (see
+        # gen_module_map). They are only stored once the shards were written.
+        self.changed_module_maps = {}
 
     # Writes the necessary CMake commands to generate the given target
     # to the given out stream (which needs to support a 'write' call).
     def generate_target(self, target, out):
-        global allPCMTargets
         if target.is_virtual():
+            if usageRequirements and not target.external:
+                self.generate_interface_target(target, out)
             return
 
         if target.root_dict != None:
@@ -630,24 +2118,34 @@ class CMakeGenerator:
             out.write("\n  " + source)
         out.write("\n)\n\n")
 
+        unity_sources = self.unity_sources(target)
+        if unity_sources:
+            out.write("set_target_properties(" + target.symbol + " PROPERTIES UNITY_BUILD ON "
+                      "UNITY_BUILD_BATCH_SIZE " + str(unityBatchSize) + ")\n")
+            excluded = unity_sources[1]
+            if excluded:
+                out.write("set_source_files_properties(")
+                for source in excluded:
+                    out.write("\n  " + source)
+                out.write("\nPROPERTIES SKIP_UNITY_BUILD_INCLUSION ON)\n")
+            out.write("\n")
+
 
-        headers = self.get_headers(target.dir + "/interface/")
         if cxxmodules:
-            with open(target.dir + "/moduletrigger.cxx", "w") as dummy:
-                if len(headers):
-                    dummy.write("#include \"")
-                    dummy.write(headers[0])
-                    dummy.write("\"\n")
+            self.write_module_trigger(target)
             out.write("add_library(")
             out.write(target.symbol)
             out.write("_PCM SHARED ")
             out.write("moduletrigger.cxx)\n")
-            allPCMTargets.append(target.symbol + "_PCM")
+            self.pcm_targets.append(target.symbol + "_PCM")
 
             out.write("add_custom_command(TARGET " + target.symbol + "_PCM")
             out.write(" PRE_BUILD COMMAND touch /dev/null )\n")
+            if target.symbol + "_PCM" in self.pcm_background:
+                out.write("set_property(TARGET " + target.symbol + "_PCM PROPERTY "
+                          "JOB_POOL_COMPILE pcm_background)\n")
 
-            for d in target.dependencies:
+            for d in sorted(target.dependencies, key=lambda d: d.name):
                 if d.built_by_cmake():
                     out.write("add_dependencies(")
                     out.write(target.symbol)
@@ -661,54 +2159,312 @@ class CMakeGenerator:
             out.write(target.symbol)
             out.write("_PCM)\n\n")
 
-        for dir in target.include_dirs:
-            out.write("target_include_directories(" + target.symbol +
-                            " PUBLIC " + dir + ")\n")
+        if usageRequirements:
             if cxxmodules:
+                # The PCM gets the include directories that CMake propagates
+                # to the target (without linking against its dependencies).
+                out.write("target_include_directories(" + target.symbol + "_PCM PRIVATE "
+                          "$<TARGET_PROPERTY:" + target.symbol + ",INCLUDE_DIRECTORIES>)\n")
+        else:
+            # The pruned include directories of a target must not propagate to
+            # the targets that link against it.
+            scope = " PRIVATE " if pruneIncludes else " PUBLIC "
+            for dir in sorted(target.include_dirs):
                 out.write("target_include_directories(" + target.symbol +
-                                "_PCM PUBLIC " + dir + ")\n")
+                                scope + dir + ")\n")
+                if cxxmodules:
+                    out.write("target_include_directories(" + target.symbol +
+                                    "_PCM" + scope + dir + ")\n")
         
+        if precompiledHeaders:
+            headers = self.select_precompiled_headers(target)
+            if headers:
+                # The headers are C++, so C sources must not get a PCH.
+                has_c_sources = any(s.endswith(".c") for s in target.source_files)
+                out.write("target_precompile_headers(" + target.symbol + " PRIVATE")
+                for header in headers:
+                    if has_c_sources:
+                        header = "$<$<COMPILE_LANGUAGE:CXX>:" + header + ">"
+                    out.write("\n  " + header)
+                out.write("\n)\n")
+
         if not noLink and len(target.defines) != 0:
             out.write("target_compile_definitions(" + target.symbol
                       + " PUBLIC " + target.defines + ")\n")
 
-        if not noLink and len(target.cxx_flags) != 0:
+        # CMake doesn't combine sources with their own COMPILE_FLAGS in unity
+        # builds, so the flags are set for the whole target instead.
+        if not noLink and len(target.cxx_flags) != 0 and unity_sources:
+            out.write("target_compile_options(" + target.symbol + " PRIVATE " +
+                      target.cxx_flags + ")\n")
+        elif not noLink and len(target.cxx_flags) != 0:
             out.write("set_source_files_properties(\n")
             for source in target.source_files:
                 out.write("\n  " + source)
             out.write("\n")
             out.write("PROPERTIES COMPILE_FLAGS \"" + target.cxx_flags + "\")\n")
 
+        # CMake doesn't allow mixing target_link_libraries calls with and
+        # without keywords for a target.
+        link_keyword = ""
+        if usageRequirements:
+            link_keyword = " PRIVATE" if target.is_executable and not noLink else " PUBLIC"
+
         if not noLink and len(target.ld_flags.strip()) != 0:
             out.write("# Manually defined LD_FLAGS\n")
-            out.write("target_link_libraries(" + target.symbol + 
+            out.write("target_link_libraries(" + target.symbol + link_keyword +
                       " " + target.ld_flags + ")\n")
 
-        if not noLink and len(target.needed_libs) != 0:
+        if usageRequirements:
+            dependencies = self.usage_dependencies(target)
+            if dependencies:
+                out.write("target_link_libraries(" + target.symbol + link_keyword)
+                for d in dependencies:
+                    out.write("\n  " + d)
+                out.write("\n)\n")
+        elif not noLink and len(target.needed_libs) != 0:
             out.write("target_link_libraries(" + target.symbol + "\n")
-            for lib in target.needed_libs:
+            for lib in sorted(target.needed_libs):
                 out.write("  " + lib + "\n")
             out.write(")\n")
         out.write("\n")
 
-    # Generates the CMakeLists.txt for a given target. Note: This function APPENDS to an
-    # existing CMakeLists.txt, because multiple targets are each written by their own
+    # Returns the names of the CMake targets of the direct dependencies of the
+    # given target with '--usage-requirements'.
+    def usage_dependencies(self, target):
+        return sorted(set(usage_target_name(d) for d in target.dependencies if not d.is_executable))
+
+    # Writes an INTERFACE library for a package without sources, which only
+    # forwards the usage requirements of its dependencies.
+    def generate_interface_target(self, target, out):
+        out.write("add_library(" + target.symbol + " INTERFACE)\n")
+        dependencies = self.usage_dependencies(target)
+        if dependencies:
+            out.write("target_link_libraries(" + target.symbol + " INTERFACE")
+            for d in dependencies:
+                out.write("\n  " + d)
+            out.write("\n)\n")
+        out.write("\n")
+
+    # Writes INTERFACE IMPORTED targets for all external targets (e.g. from
+    # builtin.json) that the project uses. Their include directories and
+    # libraries become usage requirements, and their `forwards` and
+    # dependencies become INTERFACE_LINK_LIBRARIES.
+    def gen_imported_targets(self, out):
+        todo = [d for module in self.project.modules for t in module.targets
+                for d in t.dependencies if d.external]
+        used = set()
+        while todo:
+            target = todo.pop()
+            if target in used:
+                continue
+            used.add(target)
+            todo += [self.project.get_target(f) for f in target.forwards]
+            todo += [d for d in target.dependencies if d.external]
+
+        for target in sorted(used, key=lambda t: t.name):
+            name = usage_target_name(target)
+            # CMake rejects imported targets with include directories that
+            # don't exist (builtin.json lists the paths of all known setups).
+            include_dirs = [d for d in sorted(target.direct_include_dirs) if os.path.isdir(d)]
+            links = sorted(target.direct_libs)
+            links += sorted(set(usage_target_name(self.project.get_target(f)) for f in target.forwards))
+            links += self.usage_dependencies(target)
+            out.write("add_library(" + name + " INTERFACE IMPORTED GLOBAL)\n")
+            if include_dirs or links:
+                out.write("set_target_properties(" + name + " PROPERTIES")
+                if include_dirs:
+                    out.write("\n  INTERFACE_INCLUDE_DIRECTORIES \"" + ";".join(include_dirs) + "\"")
+                if links:
+                    out.write("\n  INTERFACE_LINK_LIBRARIES \"" + ";".join(links) + "\"")
+                out.write(")\n")
+        out.write("\n")
+
+    def file_size(self, path):
+        size = self.file_sizes.get(path)
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            self.file_sizes[path] = size
+        return size
+
+    # Returns the sources of the given library target that are combined in
+    # unity builds and the ones that are excluded from them, or None if the
+    # target isn't built as a unity build. Generated sources (e.g. ROOT
+    # dictionaries) are always excluded.
+    def unity_sources(self, target):
+        if not unityBatchSize or target.is_executable or len(target.source_files) < 2:
+            return None
+        included = []
+        excluded = []
+        for source in target.source_files:
+            if (source.startswith("${CMAKE_BINARY_DIR}") or
+                    os.path.normpath(os.path.join(target.dir, source)) in self.unity_excluded):
+                excluded.append(source)
+            else:
+                included.append(source)
+        if len(included) < 2:
+            return None
+        return included, excluded
+
+    # Prints how many sources are compiled in unity builds.
+    def print_unity_report(self):
+        targets = 0
+        sources = 0
+        batches = 0
+        excluded = 0
+        for module in self.project.modules:
+            for target in module.targets:
+                unity_sources = self.unity_sources(target) if target.built_by_cmake() else None
+                if unity_sources:
+                    targets += 1
+                    sources += len(unity_sources[0])
+                    batches += -(-len(unity_sources[0]) // unityBatchSize)
+                    excluded += len(unity_sources[1])
+        if targets == 0:
+            return
+        print("Unity builds for " + str(targets) + " targets: " + str(sources) + " sources in " +
+              str(batches) + " batches (" + str(excluded) + " sources excluded)")
+
+    # Returns the headers that should be precompiled for the given target. The
+    # direct includes of all C++ sources are counted, and the headers that most
+    # sources share are ranked by how many bytes of headers (the header and
+    # everything it includes) precompiling them saves. The estimate for the
+    # target is stored in `pch_targets`.
+    def select_precompiled_headers(self, target):
+        sources = [os.path.join(target.dir, s) for s in target.source_files
+                   if not s.startswith("${CMAKE_BINARY_DIR}") and not s.endswith(".c")]
+        if len(sources) < pch_min_sources:
+            return []
+        include_dirs = (prefix, "/usr/include/") + tuple(sorted(target.include_dirs))
+        scanner = self.include_scanner
+
+        counts = {}
+        closures = []
+        for source in sources:
+            for name, quoted in scanner.get_directives(source):
+                header = scanner.resolve(name, source, quoted, include_dirs)
+                if header is not None:
+                    counts[header] = counts.get(header, 0) + 1
+            closures.append(set(scanner.transitive_includes(source, include_dirs)))
+
+        candidates = []
+        for header, count in counts.items():
+            if count < max(2, pch_min_share * len(sources)):
+                continue
+            if (header in ignored_header_set or header in textual_header_set or
+                    not header.endswith((".h", ".hh", ".hpp"))):
+                continue
+            closure = [header] + scanner.transitive_includes(header, include_dirs)
+            cost = sum(self.file_size(path) for path in closure)
+            candidates.append(((count - 1) * cost, header, closure))
+        candidates.sort(key=lambda c: (-c[0], c[1]))
+        candidates = candidates[:pch_max_headers]
+        if not candidates:
+            return []
+
+        # Everything in the PCH is parsed once instead of once per source that
+        # includes it.
+        precompiled = set()
+        for saved, header, closure in candidates:
+            precompiled.update(closure)
+        parsed = 0
+        saved = -sum(self.file_size(path) for path in precompiled)
+        for closure in closures:
+            parsed += sum(self.file_size(path) for path in closure)
+            saved += sum(self.file_size(path) for path in closure & precompiled)
+        self.pch_targets.append((target.symbol, parsed, max(0, saved),
+                                 {header: s for s, header, closure in candidates}))
+        return sorted(header for s, header, closure in candidates)
+
+    # Prints the estimated savings of the precompiled headers.
+    def print_pch_report(self):
+        parsed = sum(t[1] for t in self.pch_targets)
+        saved = sum(t[2] for t in self.pch_targets)
+        headers = {}
+        for symbol, target_parsed, target_saved, target_headers in self.pch_targets:
+            for header, header_saved in target_headers.items():
+                headers[header] = headers.get(header, 0) + header_saved
+        print("Precompiled headers for " + str(len(self.pch_targets)) + " targets: " +
+              "%.1f of %.1f MB of parsed headers saved (%.0f%%)" %
+              (saved / 1e6, parsed / 1e6, 100.0 * saved / parsed if parsed else 0))
+        for header, header_saved in sorted(headers.items(), key=lambda h: (-h[1], h[0]))[:10]:
+            print("  %8.1f MB %s" % (header_saved / 1e6, header))
+
+    # Returns the bytes of the headers that the PCM of the given target contains.
+    def pcm_header_bytes(self, target):
+        return sum(self.file_size(h) for h in self.get_headers(target.dir + "/interface/"))
+
+    # Returns the estimated cost of building the PCM of the given target.
+    def pcm_cost(self, target):
+        headers = self.get_headers(target.dir + "/interface/")
+        return self.pcm_header_bytes(target) + len(headers) * pcm_header_cost
+
+    # Returns True iff a PCM target is generated for the given target.
+    def has_pcm(self, target):
+        return target.built_by_cmake()
+
+    # Estimates the cost of each PCM, finds the critical path through the PCM
+    # dependencies and sets `pcm_priorities` and `pcm_background` accordingly.
+    # Prints the minimum wall time that the module pre-build needs.
+    def schedule_pcms(self):
+        targets = [t for module in self.project.modules for t in module.targets
+                   if self.has_pcm(t)]
+        graph = DependencyGraph(targets, self.pcm_cost)
+        cost, path = graph.longest_path()
+        chains, tails = graph.chain_costs()
+        for target in targets:
+            self.pcm_priorities[target.symbol + "_PCM"] = tails[target]
+            if chains[target] < pcm_critical_share * cost:
+                self.pcm_background.add(target.symbol + "_PCM")
+
+        total = sum(graph.weights)
+        cores = os.cpu_count() or 1
+        critical = [v for c in path for v in graph.components[c]]
+        critical_bytes = sum(self.pcm_header_bytes(graph.nodes[v]) for v in critical)
+        total_bytes = sum(self.pcm_header_bytes(t) for t in targets)
+        print("PCM schedule for " + str(len(targets)) + " PCMs: critical path of " +
+              str(len(critical)) + " PCMs with an estimated cost of %d of %d (%.1f of %.1f KB "
+              "of headers), so the module pre-build takes at least %.0f%% of its serial time "
+              "(%.0f%% with %d cores)" %
+              (cost, total, critical_bytes / 1e3, total_bytes / 1e3,
+               100.0 * cost / total if total else 0,
+               100.0 * max(cost, total / cores) / total if total else 0, cores))
+        print("  " + str(len(self.pcm_background)) + " PCMs in the pcm_background job pool")
+        for v in critical[:10]:
+            print("  %10d %s_PCM" % (graph.weights[v], graph.nodes[v].symbol))
+
+    # Returns the PCM targets in the order in which they should be built: the
+    # ones that start the most expensive chains first (with '--pcm-schedule').
+    def ordered_pcm_targets(self):
+        if not self.pcm_priorities:
+            return self.pcm_targets
+        return sorted(self.pcm_targets, key=lambda pcm: (-self.pcm_priorities.get(pcm, 0), pcm))
+
+    # Writes the moduletrigger.cxx of the given target. Compiling it builds the
+    # PCM of the target's module.
+    def write_module_trigger(self, target):
+        headers = self.get_headers(target.dir + "/interface/")
+        dummy = self.output.open(target.dir + "/moduletrigger.cxx")
+        if len(headers):
+            dummy.write("#include \"")
+            dummy.write(headers[0])
+            dummy.write("\"\n")
+
+    # Generates the CMakeLists.txt for a given target. Note: This function APPENDS to
+    # the CMakeLists.txt, because multiple targets are each written by their own
     # `handle_target` call to the same CMakeLists.txt.
     def handle_target(self, target):
         output_path = target.dir + os.sep + "CMakeLists.txt"
-        output_file = open(output_path, "a")
-        self.generate_target(target, output_file)
-        output_file.close()
+        self.generate_target(target, self.output.open(output_path))
 
 
     # Genereates the CMakeLists.txt for a given module (e.g. `FWCore/Version/CMakeLists.txt`
     def handle_module(self, module):
         output_path = module.base_dir + os.sep + "CMakeLists.txt"
-
-        if os.path.isfile(output_path):
-            return False
-
-        output_file = open(output_path, "w")
+        output_file = self.output.open(output_path)
 
         if len(module.binaries) != 0:
             output_file.write("add_subdirectory(bin)\n")
@@ -717,11 +2473,10 @@ class CMakeGenerator:
         if len(module.plugins) != 0:
             output_file.write("add_subdirectory(plugins)\n")
 
-        output_file.close()
         return True
 
     def handle_subsystem(self, subsystem, subsystem_modules):
-        subsystem_cmake = open(subsystem + os.sep + "CMakeLists.txt", "w")
+        subsystem_cmake = self.output.open(subsystem + os.sep + "CMakeLists.txt")
         for module in subsystem_modules:
             # FIXME: Another StaticAnalyzer check that is just an ugly hack...
             if module.package == "StaticAnalyzers":
@@ -766,38 +2521,47 @@ class CMakeGenerator:
 
             subsystem_cmake.write("\n)\n")
 
-        subsystem_cmake.close()
-
     # Generates the top-level CMakeLists.txt
     def gen_top_level(self):
         output_path = "CMakeLists.txt"
-        output_file = open(output_path, "w")
-
-        output_file.write("cmake_minimum_required(VERSION 3.0)\n")
+        output_file = self.output.open(output_path)
+
+        # target_precompile_headers and unity builds need CMake 3.16, imported
+        # GLOBAL targets and linking object libraries need CMake 3.12.
+        version = "3.0"
+        if usageRequirements:
+            version = "3.12"
+        if precompiledHeaders or unityBatchSize:
+            version = "3.16"
+        output_file.write("cmake_minimum_required(VERSION " + version + ")\n")
         output_file.write("project(CMSSW)\n\n")
         output_file.write("include_directories(${CMAKE_SOURCE_DIR})\n")
         output_file.write("include_directories(/usr/include/)\n")
         output_file.write("if(\"${CMAKE_CXX_COMPILER_ID}\" STREQUAL \"Clang\")\n")
         output_file.write("  set(CMAKE_CXX_FLAGS \"${CMAKE_CXX_FLAGS} -Xclang -fcolor-diagnostics\")\n")
         output_file.write("endif()\n")
-        
 
-        include_paths = set()
+        for d in global_include_dirs(self.project):
+            output_file.write("include_directories(" + d + ")\n")
 
-        for module in self.project.modules:
-            for target in module.targets:
-                include_paths |= target.include_dirs
+        for flags in global_cxx_flags("${CMAKE_BINARY_DIR}"):
+            output_file.write("set(CMAKE_CXX_FLAGS \"${CMAKE_CXX_FLAGS} " + flags + "\")\n")
 
-        for d in include_paths:
-            output_file.write("include_directories(" + d + ")\n")
+        if compilerLauncher:
+            launcher = " ".join(cmake_quote(arg) for arg in compilerLauncher)
+            output_file.write("set(CMAKE_C_COMPILER_LAUNCHER " + launcher + ")\n")
+            output_file.write("set(CMAKE_CXX_COMPILER_LAUNCHER " + launcher + ")\n")
 
-        output_file.write("set(CMAKE_CXX_FLAGS \"${CMAKE_CXX_FLAGS} -pthread -march=native -Wno-attributes "
-                          "-Wno-deprecated-declarations -Wno-deprecated-register -Wno-null-dereference -std=c++14\")\n")
-        if cxxmodules:
-            output_file.write("set(CMAKE_CXX_FLAGS \"${CMAKE_CXX_FLAGS} "
-                              "-fmodules -Wno-module-import-in-extern-c -Xclang -fmodules-local-submodule-visibility -Xclang -fdisable-module-hash -fPIC -ivfsoverlay " + prefix + "libs.overlay.yaml -fmodules-cache-path=${CMAKE_BINARY_DIR}/pcms/\")\n")
-        if printTextualHeaders:
-            output_file.write("set(CMAKE_CXX_FLAGS \"${CMAKE_CXX_FLAGS} -H\")\n")
+        if usageRequirements:
+            self.gen_imported_targets(output_file)
+
+        # Job pools are only used by CMake's Ninja generator.
+        if self.pcm_background:
+            output_file.write("cmake_host_system_information(RESULT PCM_BACKGROUND_JOBS "
+                              "QUERY NUMBER_OF_LOGICAL_CORES)\n")
+            output_file.write("math(EXPR PCM_BACKGROUND_JOBS \"(${PCM_BACKGROUND_JOBS} + 1) / 2\")\n")
+            output_file.write("set_property(GLOBAL APPEND PROPERTY JOB_POOLS "
+                              "pcm_background=${PCM_BACKGROUND_JOBS})\n")
 
 
         subsystem_list = []
@@ -807,8 +2571,6 @@ class CMakeGenerator:
 
         for subsystem in subsystem_list:
             output_file.write("add_subdirectory(" + subsystem + ")\n")
-            subsystem_modules = self.project.subsystems[subsystem]
-            self.handle_subsystem(subsystem, subsystem_modules)
 
         module_groups = {}
 
@@ -825,124 +2587,70 @@ class CMakeGenerator:
 
         if cxxmodules:
           output_file.write("\nadd_custom_target(CMSModules DEPENDS")
-          for pcm in allPCMTargets:
+          for pcm in self.ordered_pcm_targets():
             output_file.write("  " + pcm + "\n")
           output_file.write(")\n")
 
         output_file.write("\n\n")
 
-        output_file.close()
-
-        if cxxmodules:
-          self.gen_module_map()
-
     def get_headers(self, path):
-        result = set()
-        result |= set(glob.glob(path + "**/*.h", recursive=True))
-        result |= set(glob.glob(path + "**/*.hh", recursive=True))
-        result |= set(glob.glob(path + "**/*.hpp", recursive=True))
-        result |= set(glob.glob(path + "**/*.icc", recursive=True))
-        result |= set(glob.glob(path + "**/*.inc", recursive=True))
-
-        for s in list(result):
-            if s.endswith("/classes.h"):
-                result.remove(s)
-                continue
-            if s.endswith("/headers.h"):
-                result.remove(s)
-                continue
-
-            for ignored in ignored_headers:
-                if s.endswith(ignored):
-                    result.remove(s)
-                    break
-
-        result = list(result)
-        result.sort()
-        
-        return result
+        return self.header_index.get_headers(path)
 
+    # Returns True iff the given header is obsolete (see scan_obsolete). The
+    # results are stored in `obsolete_headers` (and in the ProjectCache), so
+    # only headers whose mtime or size changed are read again.
     def is_obsolete(self, path):
-        try:
-            content = open(path).read()
-            if '#error' in content and not "#if" in content:
-                print("Obsolete header ignored: " + path)
-                return True
-        except UnicodeDecodeError:
-            print("Failed to read header: " + path)
-            return False
-        return False
-
-    
+        key = stat_key(path)
+        cached = self.obsolete_headers.get(path)
+        if cached is not None and cached[:2] == key:
+            obsolete = cached[2]
+        else:
+            try:
+                obsolete = scan_obsolete(path)
+            except OSError:
+                print("Failed to read header: " + path)
+                return False
+            self.obsolete_headers[path] = key + [obsolete]
+            self.changed_obsolete_headers[path] = key + [obsolete]
+        if obsolete:
+            print("Obsolete header ignored: " + path)
+        return obsolete
 
     def gen_module_map(self):
-        m = open("module.modulemap", "w")
+        cache = open_cache()
+        self.obsolete_headers = cache.get_obsolete_headers() if cache else {}
+        self.changed_obsolete_headers = {}
+        module_maps = cache.get_module_maps() if cache else {}
+        self.changed_module_maps = {}
+
+        # Paths of the package directories with a module map shard.
+        shards = []
+        if not shardedModuleMaps:
+            m = self.output.open("module.modulemap")
         for module in self.project.modules:
             target = module.main_lib
 
             dir_path = target.dir + "/interface/";
-            if os.path.isdir(dir_path):
-                if not perHeaderModules:
-                    m.write("module CMS_" + target.symbol + " {\n")
-                    
-                    for file in self.get_headers(dir_path):
-                        if file in ignored_headers:
-                            continue
-                        if file.endswith("headers.h"):
-                            continue
-                        if self.is_obsolete(file):
-                            continue
-                        if (file.endswith(".h") or
-                            file.endswith(".hh") or
-                            file.endswith(".hpp") or
-                            file.endswith(".icc") or
-                            file.endswith(".inc")):
-
-                            full_path = file;
-                            module_name = full_path[len(dir_path):]
-                            
-                            m.write("  module \"" + module_name + "\" { ");
-                            if full_path in textual_headers or not (file.endswith(".h") or file.endswith(".hh") or file.endswith(".hpp")):
-                                m.write("textual ")
-                            m.write("header \"" + full_path + "\" export * }\n")
-                    dir_path = target.dir + "/src/"
-                    internal_headers = self.get_headers(dir_path)
-                    if len(internal_headers) != 0 and False:
-                        m.write ("  // internal headers\n")
-                        for file in internal_headers:
-                            if file in ignored_headers:
-                                continue
-                            if self.is_obsolete(file):
-                                continue
-                            if (file.endswith(".h") or
-                                file.endswith(".hh") or
-                                file.endswith(".hpp") or
-                                file.endswith(".icc") or
-                                file.endswith(".inc")):
-
-                                full_path = file;
-                                # We could make them private in theory... m.write("  private ")
-                                m.write("  module \"" + full_path + "\" { ")
-                                if full_path in textual_headers or not (file.endswith(".h") or file.endswith(".hh") or file.endswith(".hpp")):
-                                    m.write("textual ")
-                                m.write("header \"" + full_path + "\" export * } \n")
-                    m.write("  export *\n}\n\n")
-                else: # if per header modules
-                    for file in os.listdir(target.dir + "/interface/"):
-                        if (file.endswith(".h") or file.endswith(".hh")):
-                            full_path = target.dir + "/interface/" + file;
-                            m.write(
-                            "module \"" + full_path + "\" {\n" +
-                            "    header \"" + full_path + "\"\n" +
-                            "    export *\n" +
-                            "}\n\n"
-
-                            )
-
-        m.close()
+            if not os.path.isdir(dir_path):
+                continue
+            if not shardedModuleMaps:
+                self.write_module(target, m, "")
+                continue
+
+            # The shard of a package is only written again when its header set
+            # (or one of the headers) changed since it was last written.
+            path = os.path.join(target.dir, module_map_shard)
+            signature = self.module_map_signature(dir_path)
+            if module_maps.get(path) == signature and os.path.isfile(path):
+                self.output.keep(path)
+            else:
+                self.write_module(target, self.output.open(path), prefix)
+                self.changed_module_maps[path] = signature
+            shards.append(target.dir)
+
         # Copy/create cxxmodule specific files in folder
         if cxxmodules:
-            m = open("libs.overlay.yaml", "w")
+            m = self.output.open("libs.overlay.yaml")
             m.write(
 """
 {
@@ -962,57 +2670,738 @@ class CMakeGenerator:
         'external-contents': '""" + prefix + """stl.modulemap'
       }
     ]
-  }
-  ]
-}
-"""
+  }"""
                )
-            m.close()
-            shutil.copyfile(os.path.join(script_dir, "stl.modulemap"), "stl.modulemap")
-            shutil.copyfile(os.path.join(script_dir, "system.modulemap"), "system.modulemap")
-
-    def gen(self):
-        for module in self.project.modules:
+            # Clang looks for a module.modulemap in the directories of the
+            # included headers, so the shards are mapped into the interface/
+            # directories of their packages.
+            for shard in shards:
+                m.write(",\n"
+                        "  { 'name': '" + prefix + shard + "/interface/', 'type': 'directory',\n"
+                        "    'contents': [\n"
+                        "      { 'name' : 'module.modulemap', 'type': 'file',\n"
+                        "        'external-contents': '" + prefix + shard + "/" + module_map_shard + "'\n"
+                        "      }\n"
+                        "    ]\n"
+                        "  }")
+            m.write("\n  ]\n}\n")
+            for name in ["stl.modulemap", "system.modulemap"]:
+                with open(os.path.join(script_dir, name)) as f:
+                    self.output.open(name).write(f.read())
+
+        if shardedModuleMaps:
+            print("Updated " + str(len(self.changed_module_maps)) + " of " + str(len(shards)) +
+                  " module maps")
+        if cache:
+            cache.put_obsolete_headers(self.changed_obsolete_headers)
+            cache.close()
+
+    # Returns a signature of the headers in the given interface/ directory and
+    # their mtimes and sizes, which changes whenever the module map of the
+    # package might change.
+    def module_map_signature(self, dir_path):
+        headers = [[file] + stat_key(file) for file in self.get_headers(dir_path)]
+        data = json.dumps([prefix, perHeaderModules, sorted(os.listdir(dir_path)), headers])
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    # Writes the module(s) of the given target to the module map `m`. The paths
+    # of the headers are relative to the project root and start with `header_prefix`.
+    def write_module(self, target, m, header_prefix):
+        dir_path = target.dir + "/interface/"
+        if not perHeaderModules:
+            m.write("module CMS_" + target.symbol + " {\n")
+            
+            for file in self.get_headers(dir_path):
+                if file in ignored_header_set:
+                    continue
+                if file.endswith("headers.h"):
+                    continue
+                if self.is_obsolete(file):
+                    continue
+                if (file.endswith(".h") or
+                    file.endswith(".hh") or
+                    file.endswith(".hpp") or
+                    file.endswith(".icc") or
+                    file.endswith(".inc")):
+
+                    full_path = file;
+                    module_name = full_path[len(dir_path):]
+                    
+                    m.write("  module \"" + module_name + "\" { ");
+                    if full_path in textual_header_set or not (file.endswith(".h") or file.endswith(".hh") or file.endswith(".hpp")):
+                        m.write("textual ")
+                    m.write("header \"" + header_prefix + full_path + "\" export * }\n")
+            dir_path = target.dir + "/src/"
+            internal_headers = self.get_headers(dir_path)
+            if len(internal_headers) != 0 and False:
+                m.write ("  // internal headers\n")
+                for file in internal_headers:
+                    if file in ignored_header_set:
+                        continue
+                    if self.is_obsolete(file):
+                        continue
+                    if (file.endswith(".h") or
+                        file.endswith(".hh") or
+                        file.endswith(".hpp") or
+                        file.endswith(".icc") or
+                        file.endswith(".inc")):
+
+                        full_path = file;
+                        # We could make them private in theory... m.write("  private ")
+                        m.write("  module \"" + full_path + "\" { ")
+                        if full_path in textual_header_set or not (file.endswith(".h") or file.endswith(".hh") or file.endswith(".hpp")):
+                            m.write("textual ")
+                        m.write("header \"" + header_prefix + full_path + "\" export * } \n")
+            m.write("  export *\n}\n\n")
+        else: # if per header modules
+            for file in sorted(os.listdir(target.dir + "/interface/")):
+                if (file.endswith(".h") or file.endswith(".hh")):
+                    full_path = target.dir + "/interface/" + file;
+                    m.write(
+                    "module \"" + full_path + "\" {\n" +
+                    "    header \"" + header_prefix + full_path + "\"\n" +
+                    "    export *\n" +
+                    "}\n\n"
+
+                    )
+
+    # Generates the CMakeLists.txt files of the given subsystem and all its packages.
+    def gen_subsystem(self, subsystem):
+        subsystem_modules = self.project.subsystems[subsystem]
+        for module in subsystem_modules:
             if self.handle_module(module):
                 for target in module.targets:
                     self.handle_target(target)
-        self.gen_top_level()
-
-# Dummy code in test normal dict generation doesn't work for some reason...
-def make_dicts():
-    for root, dirs, files in os.walk("."):
-        if root.endswith("/src") and  "classes.h" in files:
-            has_xml = ("classes_def.xml" in files)
-            command = "genreflex classes.h -I" + os.getcwd()
-            if has_xml:
-                command += " -s classes_def.xml"
-            print("Generating dict for " + root)
-            subprocess.call(command, shell=True, cwd=root)
+        self.handle_subsystem(subsystem, subsystem_modules)
+
+    # Generates the files of the given subsystem in a separate OutputTree and
+    # returns their content, the PCM and PCH targets and the headers that were found.
+    def render_subsystem(self, subsystem):
+        self.output = OutputTree()
+        self.pcm_targets = []
+        self.pch_targets = []
+        self.gen_subsystem(subsystem)
+        files = {path: content.getvalue() for path, content in self.output.files.items()}
+        return files, self.pcm_targets, self.pch_targets, self.header_index.headers
+
+    # Generates the CMakeLists.txt files of all subsystems and packages. The
+    # subsystems are independent of each other, so with '-j' they are generated
+    # by worker processes. The results are merged in the order of the subsystem
+    # names, so the output is the same as when generating them one by one.
+    def gen_modules(self):
+        # The schedule is needed for generating the PCM targets of all subsystems.
+        if cxxmodules and pcmSchedule:
+            self.schedule_pcms()
+        subsystems = sorted(self.project.subsystems)
+        if jobs <= 1 or len(subsystems) <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            for subsystem in subsystems:
+                self.gen_subsystem(subsystem)
+            return
 
-def main():
-    #make_dicts()
+        # The workers need the whole resolved project, which is shared with
+        # them by forking after setting `worker_generator`.
+        global worker_generator
+        worker_generator = self
+        try:
+            with multiprocessing.get_context("fork").Pool(jobs) as pool:
+                results = pool.map(render_subsystem_in_worker, subsystems)
+        finally:
+            worker_generator = None
+
+        for files, pcm_targets, pch_targets, headers, worker_stats in results:
+            for path, content in files.items():
+                self.output.open(path).write(content)
+            self.pcm_targets += pcm_targets
+            self.pch_targets += pch_targets
+            self.header_index.headers.update(headers)
+            if worker_stats:
+                stats.merge(worker_stats)
 
-    # Create an empty ScramProject
-    project = ScramProject()
+    def gen(self):
+        with phase("gen_modules"):
+            self.gen_modules()
+        if self.pch_targets:
+            self.print_pch_report()
+        if unityBatchSize:
+            self.print_unity_report()
+        with phase("gen_top_level"):
+            self.gen_top_level()
+        if cxxmodules:
+            with phase("gen_module_map"):
+                self.gen_module_map()
+        with phase("write"):
+            self.output.commit()
+        cache = open_cache() if self.changed_module_maps else None
+        if cache:
+            cache.put_module_maps(self.changed_module_maps)
+            cache.close()
+
+# Writes a compile_commands.json for the given ScramProject directly from the
+# targets, so IDEs can index the project without generating CMake files and
+# running CMake. The compile commands contain the same flags that the generated
+# CMake files would use.
+class CompileCommandsGenerator:
+    output_path = "compile_commands.json"
+    # Directory (relative to the project root) used for build output in the flags.
+    build_dir = "build"
 
-    # traverse root directory, and list directories as dirs and files as files
-    for root, dirs, files in os.walk("."):
-        for file in files:
-            root = remove_str_refix(root, "./")
-            if len(root.split("/")) != 2:
-              continue;
-            if file == "BuildFile.xml":
-                path = os.path.join(root, file)
-                m = handle_BuildFileXml(root, path)
-                if m:
-                    project.add_module(m)
+    def __init__(self, project):
+        self.project = project
+        self.cxx = shlex.split(os.environ.get("CXX", "c++"))
+        self.cc = shlex.split(os.environ.get("CC", "cc"))
+        self.include_args = global_include_args(project)
+        self.global_include_args = set(self.include_args)
+        self.cxx_args = shlex.split(" ".join(global_cxx_flags(prefix + self.build_dir)))
+
+    # Returns the compile_commands.json entries for all sources of the given target.
+    def target_entries(self, target):
+        target_args = target_compile_args(target, self.global_include_args)
+        directory = os.path.normpath(prefix + target.dir)
+        for source in target.source_files:
+            # Generated ROOT dictionaries only exist in CMake builds.
+            if source.startswith("${CMAKE_BINARY_DIR}"):
+                continue
+            path = os.path.join(directory, source)
+            if source.endswith(".c"):
+                arguments = self.cc + self.include_args + target_args
+            else:
+                arguments = self.cxx + self.cxx_args + self.include_args + target_args
+            yield {"directory": directory, "file": path, "arguments": arguments + ["-c", path]}
 
-    project.resolve_dependencies()
+    # Writes the entries one by one to a temporary file which then replaces
+    # the compile_commands.json.
+    def gen(self):
+        tmp_path = self.output_path + ".tmp" + str(os.getpid())
+        count = 0
+        with open(tmp_path, "w") as out:
+            out.write("[")
+            for module in self.project.modules:
+                for target in module.targets:
+                    if not target.built_by_cmake():
+                        continue
+                    for entry in self.target_entries(target):
+                        out.write(",\n" if count else "\n")
+                        out.write(json.dumps(entry))
+                        count += 1
+            out.write("\n]\n")
+        os.replace(tmp_path, self.output_path)
+        print("Wrote " + str(count) + " compile commands to " + self.output_path)
+
+# Escapes a path for the outputs and inputs of a build statement in a build.ninja.
+def ninja_path(path):
+    return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+# Returns the given arguments as the (shell quoted) value of a build.ninja variable.
+def ninja_args(args):
+    return " ".join(shlex.quote(arg) for arg in args).replace("$", "$$")
+
+# Generates build.ninja files for the given ScramProject, so builds that are
+# thrown away afterwards (e.g. in CI) can skip generating and configuring the
+# CMake files. The build has the same targets, flags and meta-targets as the
+# generated CMake files. Like those, every subsystem has its own file (which
+# the top-level build.ninja includes with 'subninja'), so the subsystems are
+# still generated in parallel and only changed ones are written with
+# '--incremental'. Ninja has to be started in the project root.
+class NinjaGenerator(CMakeGenerator):
+    # Directory (relative to the project root) that contains all build output.
+    build_dir = "build"
+
+    def __init__(self, project):
+        super().__init__(project)
+        self.global_include_args = global_include_args(project)
+        # All targets that get build statements. Like in the CMake files, the
+        # StaticAnalyzers package is skipped.
+        self.built_targets = set()
+        for module in project.modules:
+            if module.package != "StaticAnalyzers":
+                self.built_targets |= {t for t in module.targets if t.built_by_cmake()}
+        # Library name -> path of the shared library for all libraries built
+        # by the project (the other names are passed to the linker as '-l').
+        self.library_paths = {}
+        # Library name -> target for the same libraries.
+        self.library_targets = {}
+        for target in self.built_targets:
+            if not target.is_executable:
+                self.library_paths[target.symbol] = self.output_file(target)
+                self.library_targets[target.symbol] = target
+
+    def output_file(self, target):
+        if target.is_executable:
+            return self.build_dir + "/bin/" + target.symbol
+        return self.build_dir + "/lib/lib" + target.symbol + ".so"
+
+    def source_path(self, target, source):
+        if source.startswith("${CMAKE_BINARY_DIR}/"):
+            return self.build_dir + "/" + source[len("${CMAKE_BINARY_DIR}/"):]
+        return os.path.normpath(os.path.join(target.dir, source))
+
+    def object_file(self, target, source):
+        source = remove_str_refix(source, "${CMAKE_BINARY_DIR}/")
+        return self.build_dir + "/obj/" + target.symbol + "/" + os.path.normpath(source) + ".o"
+
+    # Returns the libraries that the given target links against. Like with
+    # target_link_libraries in CMake, this includes the libraries that the
+    # project libraries it links against link against.
+    def link_libraries(self, target):
+        result = set(target.needed_libs)
+        todo = [lib for lib in target.needed_libs if lib in self.library_targets]
+        while todo:
+            for lib in self.library_targets[todo.pop()].needed_libs:
+                if lib not in result:
+                    result.add(lib)
+                    if lib in self.library_targets:
+                        todo.append(lib)
+        result.discard(target.symbol)
+        return result
+
+    # Returns the linker arguments and the project libraries of the given target.
+    # Like CMake, the directories of libraries given by path (e.g. from a
+    # release) are added to the RPATH.
+    def link_args(self, target):
+        args = shlex.split(target.ld_flags)
+        libraries = []
+        rpath = set()
+        for lib in sorted(self.link_libraries(target)):
+            if lib in self.library_paths:
+                libraries.append(self.library_paths[lib])
+                args.append(self.library_paths[lib])
+            elif lib.startswith("-"):
+                args.append(lib)
+            elif "/" in lib:
+                args.append(lib)
+                rpath.add(os.path.dirname(lib))
+            else:
+                args.append("-l" + lib)
+        args += ["-Wl,-rpath," + d for d in sorted(rpath)]
+        return args, libraries
+
+    # Writes the build statements of the given target to the given stream.
+    def generate_target(self, target, out):
+        if target not in self.built_targets:
+            return
+        out.write("# " + target.name + "\n")
+
+        if target.root_dict != None:
+            out.write(target.root_dict.ninja_build(self.build_dir))
+
+        include_args = ["-I" + d for d in sorted(target.include_dirs)
+                        if "-I" + d not in self.global_include_args]
+        flags = target_compile_args(target, self.global_include_args)
+        # CMake compiles the sources of shared libraries (and the PCM targets) with -fPIC.
+        if not noLink and not target.is_executable:
+            flags.insert(0, "-fPIC")
+
+        order_only = ""
+        if cxxmodules:
+            self.write_module_trigger(target)
+            pcm = target.symbol + "_PCM"
+            pcm_object = self.build_dir + "/pcm/" + pcm + ".o"
+            self.pcm_targets.append(pcm)
+            pcm_deps = [d.symbol + "_PCM" for d in sorted(target.dependencies, key=lambda d: d.name)
+                        if d in self.built_targets]
+            out.write("build " + ninja_path(pcm_object) + ": cxx " +
+                      ninja_path(target.dir + "/moduletrigger.cxx"))
+            if pcm_deps:
+                out.write(" || " + " ".join(pcm_deps))
+            out.write("\n  flags = " + ninja_args(["-fPIC"] + include_args) + "\n")
+            if pcm in self.pcm_background:
+                out.write("  pool = pcm_background\n")
+            out.write("build " + pcm + ": phony " + ninja_path(pcm_object) + "\n")
+            order_only = " || " + pcm
+
+        objects = []
+        for source in target.source_files:
+            obj = self.object_file(target, source)
+            objects.append(ninja_path(obj))
+            rule = "cc" if source.endswith(".c") else "cxx"
+            out.write("build " + objects[-1] + ": " + rule + " " +
+                      ninja_path(self.source_path(target, source)) + order_only + "\n")
+            out.write("  flags = " + ninja_args(flags) + "\n")
+
+        if noLink:
+            out.write("build " + target.symbol + ": phony " + " ".join(objects) + "\n\n")
+            return
+
+        output = ninja_path(self.output_file(target))
+        args, libraries = self.link_args(target)
+        out.write("build " + output + ": " + ("link_exe" if target.is_executable else "link_shared") +
+                  " " + " ".join(objects))
+        if libraries:
+            out.write(" | " + " ".join(ninja_path(lib) for lib in libraries))
+        out.write("\n  libs = " + ninja_args(args) + "\n")
+        if not target.is_executable:
+            out.write("  soname = " + os.path.basename(self.output_file(target)) + "\n")
+        out.write("build " + target.symbol + ": phony " + output + "\n\n")
+
+    def subsystem_file(self, subsystem):
+        return subsystem + os.sep + "build.ninja"
+
+    # Unity builds are only supported in the CMake files.
+    def unity_sources(self, target):
+        return None
+
+    def has_pcm(self, target):
+        return target in self.built_targets
+
+    def handle_target(self, target):
+        self.generate_target(target, self.output.open(self.subsystem_file(target.module.subsystem)))
 
-    generator = CMakeGenerator(project)
+    def handle_module(self, module):
+        return module.package != "StaticAnalyzers"
+
+    def handle_subsystem(self, subsystem, subsystem_modules):
+        out = self.output.open(self.subsystem_file(subsystem))
+        targets = [t for module in subsystem_modules for t in module.targets
+                   if t in self.built_targets and t.symbol != "UtilitiesStaticAnalyzers"]
+        libs = [t for t in targets if t is t.module.main_lib]
+        if targets:
+            out.write("# Meta-target that builds everything in this subsystem\n")
+            out.write("build " + subsystem + "_all: phony " +
+                      " ".join(t.symbol for t in targets) + "\n")
+        if libs:
+            out.write("# Meta-target that builds all libs in this subsystem\n")
+            out.write("build " + subsystem + "_libs: phony " +
+                      " ".join(t.symbol for t in libs) + "\n")
+
+    # Generates the top-level build.ninja with the rules and global flags.
+    def gen_top_level(self):
+        out = self.output.open("build.ninja")
+        binary_dir = prefix + self.build_dir
+        out.write("ninja_required_version = 1.3\n")
+        out.write("builddir = " + self.build_dir + "\n\n")
+        if compilerLauncher:
+            out.write("launcher = " + ninja_args(compilerLauncher) + "\n")
+        out.write("cxx = " + ninja_args(shlex.split(os.environ.get("CXX", "c++"))) + "\n")
+        out.write("cc = " + ninja_args(shlex.split(os.environ.get("CC", "cc"))) + "\n")
+        out.write("cxxflags = " + ninja_args(shlex.split(" ".join(global_cxx_flags(binary_dir)))) + "\n")
+        out.write("includes = " + ninja_args(self.global_include_args) + "\n")
+        out.write("ldflags = " + ninja_args(["-Wl,-rpath," + binary_dir + "/lib"]) + "\n")
+        out.write("genreflex = " + ninja_args(shlex.split(genreflexCommand)) + "\n")
+        out.write("root = " + ninja_args([prefix]) + "\n\n")
+
+        launcher = "$launcher " if compilerLauncher else ""
+        out.write("rule cxx\n"
+                  "  command = " + launcher + "$cxx $cxxflags $includes $flags -MD -MF $out.d -c $in -o $out\n"
+                  "  depfile = $out.d\n"
+                  "  deps = gcc\n"
+                  "  description = CXX $out\n\n"
+                  "rule cc\n"
+                  "  command = " + launcher + "$cc $includes $flags -MD -MF $out.d -c $in -o $out\n"
+                  "  depfile = $out.d\n"
+                  "  deps = gcc\n"
+                  "  description = CC $out\n\n"
+                  "rule link_shared\n"
+                  "  command = $cxx $cxxflags -shared -Wl,-soname,$soname -o $out $in $ldflags $libs\n"
+                  "  description = LINK $out\n\n"
+                  "rule link_exe\n"
+                  "  command = $cxx $cxxflags -o $out $in $ldflags $libs\n"
+                  "  description = LINK $out\n\n"
+                  "rule genreflex\n"
+                  "  command = $genreflex $in -I$root -o $out $xml_args\n"
+                  "  description = Generating ROOT dict $out\n\n")
+        if makeDicts:
+            out.write("rule copy\n"
+                      "  command = cp $in $out\n"
+                      "  description = Copying pre-generated ROOT dict $out\n\n")
+
+        if self.pcm_background:
+            out.write("pool pcm_background\n"
+                      "  depth = " + str(((os.cpu_count() or 1) + 1) // 2) + "\n\n")
+
+        subsystems = sorted(self.project.subsystems)
+        for subsystem in subsystems:
+            out.write("subninja " + ninja_path(self.subsystem_file(subsystem)) + "\n")
+
+        all_targets = sorted(t.symbol for t in self.built_targets)
+        out.write("\nbuild all: phony " + " ".join(all_targets) + "\n")
+        if cxxmodules:
+            out.write("build CMSModules: phony " + " ".join(self.ordered_pcm_targets()) + "\n")
+        out.write("default all\n")
+
+# The CMakeGenerator whose subsystems are generated by the worker processes.
+worker_generator = None
+
+def render_subsystem_in_worker(subsystem):
+    global stats
+    if stats:
+        stats = Stats()
+    return worker_generator.render_subsystem(subsystem) + (stats,)
+
+# Directory in the project root that '--dicts' writes the dictionaries to. It's
+# outside of the packages, so the dictionaries aren't picked up as sources (the
+# generated build files copy them into the build directory instead).
+dicts_dir = ".scram2cmake-dicts"
+
+# Absolute paths of the dictionaries in `dicts_dir` that were successfully
+# generated for the current inputs and command in this run.
+pregenerated_dicts = set()
+
+# Returns the genreflex command line for the dictionary in the given src/
+# directory, which is written to `output`.
+def dict_command(src_dir, has_xml, output):
+    command = shlex.split(genreflexCommand) + ["classes.h", "-I" + os.getcwd(),
+                                               "-o", output]
+    if has_xml:
+        command += ["-s", "classes_def.xml"]
+    return command
+
+# Runs genreflex in the given directory and returns whether it succeeded,
+# how long it took and its output.
+def run_dict_job(src_dir, command):
+    start = time.perf_counter()
+    try:
+        result = subprocess.run(command, cwd=src_dir, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        success = result.returncode == 0
+        output = result.stdout.decode(errors="replace")
+    except OSError as e:
+        success = False
+        output = str(e)
+    return success, time.perf_counter() - start, output
+
+# Generates the ROOT dictionaries (src/classes.h and src/classes_def.xml) of the
+# given packages by running genreflex in up to `jobs` parallel processes.
+# Dictionaries are skipped if the command, the output and all their inputs
+# (classes.h, classes_def.xml and all headers included by classes.h) are
+# unchanged since the last successful run. Returns the number of failed jobs.
+def make_dicts(packages):
+    cache = open_cache()
+    old_dictionaries = cache.get_dictionaries() if cache else {}
+    scanner = IncludeScanner()
+
+    todo = []
+    up_to_date = 0
+    for root in packages:
+        src_dir = os.path.join(root, "src")
+        classes_h = os.path.join(src_dir, "classes.h")
+        if not os.path.isfile(classes_h):
+            continue
+        classes_xml = os.path.join(src_dir, "classes_def.xml")
+        has_xml = os.path.isfile(classes_xml)
+        output = os.path.join(os.getcwd(), dicts_dir,
+                              RootDict(os.path.realpath(classes_h), None).cpp_file)
+        # genreflex writes to a temporary file that only replaces the output
+        # when it succeeded, so a failed run never leaves a partial dictionary.
+        command = dict_command(src_dir, has_xml, output + ".tmp")
+
+        old = old_dictionaries.get(src_dir)
+        if (old is not None and old[0] == command and
+                os.path.isfile(output) and check_stamp(old[1])[0]):
+            pregenerated_dicts.add(output)
+            up_to_date += 1
+            continue
+
+        # The stamp is created before running genreflex, so changes made while
+        # it is running cause another run next time.
+        inputs = [classes_h] + ([classes_xml] if has_xml else [])
+        inputs += scanner.transitive_includes(classes_h, (".",))
+        todo.append((src_dir, command, [[path] + stat_key(path) for path in inputs], output))
+
+    failed = []
+    timings = []
+    if todo:
+        os.makedirs(dicts_dir, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        futures = {executor.submit(run_dict_job, src_dir, command): (src_dir, command, stamp, path)
+                   for src_dir, command, stamp, path in todo}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            src_dir, command, stamp, path = futures[future]
+            success, seconds, output = future.result()
+            if success:
+                try:
+                    os.replace(path + ".tmp", path)
+                except OSError as e:
+                    success = False
+                    output = str(e)
+            timings.append((seconds, src_dir))
+            print("[" + str(done) + "/" + str(len(todo)) + "] " +
+                  ("Generated" if success else "FAILED") + " dict for " + src_dir +
+                  " (%.2fs)" % seconds)
+            if success:
+                pregenerated_dicts.add(path)
+                if cache:
+                    cache.put_dictionary(src_dir, command, stamp)
+            else:
+                # The dictionary of an earlier run doesn't match the inputs anymore.
+                for stale in (path + ".tmp", path):
+                    if os.path.isfile(stale):
+                        os.remove(stale)
+                if cache:
+                    cache.remove_dictionary(src_dir)
+                failed.append(src_dir)
+                print(output)
+
+    if cache:
+        cache.close()
+
+    print("Dictionaries: " + str(len(todo) - len(failed)) + " generated, " +
+          str(up_to_date) + " up to date, " + str(len(failed)) + " failed")
+    timings.sort(reverse=True)
+    for seconds, src_dir in timings[:5]:
+        print("  %.2fs %s" % (seconds, src_dir))
+    for src_dir in sorted(failed):
+        print("  Failed: " + src_dir)
+    return len(failed)
+
+# Indexes the base release (e.g. $CMSSW_RELEASE_BASE) at the given path. The
+# headers and BuildFile.xml files of its packages are in src/ and the libraries
+# in lib/<arch>/. Returns a dict with the include directories of the release
+# and package name -> {'libs': [library paths], 'uses': [dependency names]}.
+# The stamp of the directories and BuildFile.xml files that were read is
+# returned as well.
+def index_release(path):
+    src = os.path.join(path, "src")
+    lib_dirs = sorted(glob.glob(os.path.join(path, "lib", "*", "")))
+    packages = scan_packages(src)[0] if os.path.isdir(src) else []
+    subsystems = sorted(set(package.split("/")[0] for package in packages))
+    stamp_paths = ([os.path.join(path, "lib"), src] + lib_dirs +
+                   [os.path.join(src, subsystem) for subsystem in subsystems] +
+                   [os.path.join(src, package, "BuildFile.xml") for package in packages])
+    stamp = [[p] + stat_key(p) for p in stamp_paths]
+
+    # Library symbol (e.g. 'FWCoreFramework') -> path of the shared library.
+    libraries = {}
+    for lib_dir in lib_dirs:
+        for name in sorted(os.listdir(lib_dir)):
+            if name.startswith("lib") and name.endswith(".so"):
+                libraries.setdefault(name[3:-3], os.path.join(lib_dir, name))
+
+    release = {"include_dirs": [], "packages": {}}
+    for d in [src, os.path.join(path, "include")]:
+        if os.path.isdir(d):
+            release["include_dirs"].append(d + os.sep)
+    for package in packages:
+        node = parse_BuildFileXml(os.path.join(src, package, "BuildFile.xml"))
+        uses = set()
+        if node is not None:
+            for child in node:
+                if child.tag == "use" or child.tag == "lib":
+                    uses.add(get_lib_or_name_attr(child))
+        symbol = package.replace("/", "").replace("-", "")
+        libs = [libraries[symbol]] if symbol in libraries else []
+        release["packages"][package] = {"libs": libs, "uses": sorted(uses)}
+    return stamp, release
+
+# Returns the index of the base release at the given path (see index_release).
+# The index is stored in the ProjectCache and only created again when the
+# release changed.
+def load_release(path):
+    cache = open_cache()
+    release = cache.get_release(path) if cache else None
+    if release is None:
+        stamp, release = index_release(path)
+        print("Indexed " + str(len(release["packages"])) + " packages of the release in " + path)
+        if cache:
+            cache.put_release(path, stamp, release)
+    if cache:
+        cache.close()
+    return release
+
+# Creates a ScramProject with the given (parsed) modules and resolves all
+# dependencies between their targets. With '--release', the packages of the
+# release that aren't in the given modules are added as external targets. The
+# release index is loaded unless it is passed in.
+def create_project(modules, release=None):
+    project = ScramProject()
+    for m in modules:
+        if m:
+            project.add_module(m)
+    if releasePath:
+        added = project.add_release(release or load_release(releasePath))
+        print("Using " + str(added) + " packages from the release in " + releasePath)
+    project.resolve_dependencies()
+    return project
+
+# Runs the whole pipeline on the SCRAM project in the working directory.
+# Returns the number of errors (e.g. failed dictionaries).
+def run():
+    errors = 0
+
+    release = None
+    if releasePath:
+        # Without any packages of the release, everything that isn't checked
+        # out would silently be missing from the link lines.
+        release = load_release(releasePath)
+        if not release["packages"]:
+            print("No packages found in the release in " + releasePath)
+            return 1
+
+    if onlyPackages:
+        # Nothing is generated if a package is missing, as generating only the
+        # others would replace the top-level files of a working tree.
+        missing = [package for package in onlyPackages if not is_package_dir(package)]
+        for package in missing:
+            print("Package not found: " + package)
+        if missing:
+            return len(missing)
+        with phase("parse"):
+            packages, modules = parse_package_closure(onlyPackages)
+        print("Generating " + str(len(packages)) + " packages (" + str(len(onlyPackages)) +
+              " requested and their dependencies)")
+        if makeDicts:
+            with phase("dicts"):
+                errors += make_dicts(packages)
+    else:
+        # Find all packages in the project
+        with phase("scan"):
+            packages, visited = scan_packages()
+        if scanStats:
+            print("Scanned " + str(visited) + " directories (full walk: " +
+                  str(count_walk_dirs()) + ") and found " + str(len(packages)) + " packages")
+
+        if makeDicts:
+            with phase("dicts"):
+                errors += make_dicts(packages)
+
+        with phase("parse"):
+            modules = parse_packages(packages)
+    with phase("resolve_dependencies"):
+        project = create_project(modules, release)
+
+    if pruneIncludes and usageRequirements and not (compileCommands or ninjaBuild):
+        print("--prune-includes is ignored for the CMake files with --usage-requirements, "
+              "as CMake propagates the include directories of the dependencies")
+    elif pruneIncludes:
+        with phase("prune_includes"):
+            prune_include_dirs(project)
+
+    if graphReport:
+        with phase("graph_report"):
+            write_graph_report(project)
+
+    if compileCommands:
+        with phase("compile_commands"):
+            CompileCommandsGenerator(project).gen()
+        return errors
+
+    if ninjaBuild:
+        generator = NinjaGenerator(project)
+    else:
+        generator = CMakeGenerator(project)
     generator.gen()
+    return errors
+
+def main():
+    if statsJson:
+        enable_stats()
+    profiler = None
+    if profileOutput:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    with phase("total"):
+        errors = run()
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(profileOutput)
+    if stats:
+        stats.write_json(statsJson)
+    if errors:
+        exit(1)
 
 if __name__ == "__main__":
+    parse_args(sys.argv[1:])
     main()
 
 